@@ -0,0 +1,456 @@
+"""
+Headless HTTP API for Speak-To-Docs, serving the same pipeline as the Streamlit app (main.py).
+
+Run with `python api.py --port 8080`. Endpoints:
+
+    POST   /sessions                          Start a conversation, returns its session_id
+    DELETE /sessions/{session_id}             End a conversation and release its documents
+    POST   /sessions/{session_id}/documents   Upload the conversation's documents (multipart/form-data)
+    POST   /sessions/{session_id}/query       Ask a question: {"question": ..., "stream": false}
+    POST   /sessions/{session_id}/audio       Ask by voice: audio in, spoken answer out
+    POST   /transcriptions                    Speech to text: audio in, {"text": ...} out
+    POST   /speech                            Text to speech: {"text": ...} in, audio out
+    GET    /health, /metrics                  Liveness and Prometheus metrics
+
+The event loop never blocks on Azure: extraction and indexing run on a small ingest
+executor, and answering, transcription and synthesis on a larger query executor, so
+one process serves many concurrent conversations within fixed thread budgets.
+"""
+import argparse
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import quote
+
+from aiohttp import web
+from dotenv import load_dotenv
+from langchain_core.callbacks import BaseCallbackHandler
+
+from src.pipeline import (answer_question, build_qa_chain, create_answer_cache, create_embeddings, create_llm,
+                          create_segment_registry, update_vector_store)
+from src.rag_functions import RollingSummary, allowed_files, probe_file
+from src.speech_io import SPEECH_OUTPUT_FORMAT, SpeechJob, audio_mime_type, cancel_session_synthesis, transcribe_audio
+from src.telemetry import context as telemetry_context
+from src.telemetry import new_request_id, telemetry
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Same limits as the Streamlit app
+MAX_DOCUMENTS = 2
+MAX_PAGES = 50
+MAX_UPLOAD_BYTES = int(os.getenv("API_MAX_UPLOAD_MB", 50)) * 1024 * 1024
+# Threads extracting and embedding documents, each document also uses the extraction and embedding pools
+API_INGEST_WORKERS = int(os.getenv("API_INGEST_WORKERS", 2))
+# Threads answering questions and waiting on speech, mostly idle on network I/O
+API_QUERY_WORKERS = int(os.getenv("API_QUERY_WORKERS", 16))
+# Conversations idle for longer than this are ended
+API_SESSION_TTL = float(os.getenv("API_SESSION_TTL", 60 * 60))
+DEFAULT_VOICE = "en-NG-EzinneNeural"
+# Voices clients may ask for besides the default, comma-separated Azure voice names
+API_VOICES = {DEFAULT_VOICE, *(voice.strip() for voice in os.getenv("API_VOICES", "").split(",") if voice.strip())}
+
+
+def json_error(exception_class, message, **kwargs):
+    '''
+    Returns an aiohttp HTTP exception with `message` as its JSON body
+    '''
+    return exception_class(text=json.dumps({"error": message}), content_type="application/json", **kwargs)
+
+
+class Conversation:
+    """
+    State of one API session: its documents, QA chain and the rolling summary that is the chain's chat history.
+
+    Turns of a conversation run one at a time, so each answer sees the turns before it.
+    """
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.vector_store = None
+        self.qa_chain = None
+        self.summary = RollingSummary()
+        self.documents = []
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+
+class TokenQueueHandler(BaseCallbackHandler):
+    """
+    LangChain callback handler that passes streamed tokens from a worker thread to an asyncio queue.
+    """
+
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, token)
+
+
+class Engine:
+    """
+    The models and caches shared by all conversations, and the executors blocking calls run on.
+    """
+
+    def __init__(self):
+        self.llm = create_llm()
+        self.embeddings = create_embeddings()
+        self.answer_cache = create_answer_cache()
+        self.registry = create_segment_registry()
+        self.ingest_executor = ThreadPoolExecutor(max_workers=API_INGEST_WORKERS, thread_name_prefix="api-ingest")
+        self.query_executor = ThreadPoolExecutor(max_workers=API_QUERY_WORKERS, thread_name_prefix="api-query")
+        self.conversations = {}
+
+    async def run(self, executor, fn, *args, **kwargs):
+        '''
+        Runs a blocking call on `executor` in a copy of the current context, so its spans keep the request's IDs
+        '''
+        loop = asyncio.get_running_loop()
+        call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+        return await loop.run_in_executor(executor, call)
+
+    def conversation(self, session_id):
+        conversation = self.conversations.get(session_id)
+        if conversation is None:
+            raise json_error(web.HTTPNotFound, f"Unknown session {session_id}.")
+        conversation.last_used = time.monotonic()
+        return conversation
+
+    def end(self, session_id):
+        conversation = self.conversations.pop(session_id, None)
+        if conversation is not None:
+            cancel_session_synthesis(session_id)
+            self.registry.release_session(session_id)
+        return conversation
+
+    async def expire_sessions(self):
+        while True:
+            await asyncio.sleep(60)
+            now = time.monotonic()
+            for session_id, conversation in list(self.conversations.items()):
+                if now - conversation.last_used > API_SESSION_TTL and not conversation.lock.locked():
+                    self.end(session_id)
+                    logger.info(f"Ended idle session {session_id}.")
+
+    def shutdown(self):
+        self.ingest_executor.shutdown(wait=False, cancel_futures=True)
+        self.query_executor.shutdown(wait=False, cancel_futures=True)
+
+    async def synthesize(self, text, session_id=None, voice_name=DEFAULT_VOICE):
+        """
+        Synthesizes `text` sentence by sentence on the shared synthesis executor.
+
+        Returns:
+            bytes: The audio in `SPEECH_OUTPUT_FORMAT`.
+        """
+        output_file = f"{uuid.uuid4().hex}.{SPEECH_OUTPUT_FORMAT}"
+        job = await self.run(self.query_executor, SpeechJob, text, output_file, session_id=session_id,
+                             voice_name=voice_name)
+        await asyncio.gather(*(asyncio.wrap_future(future) for _, future in job.segments), return_exceptions=True)
+        success, message = await self.run(self.query_executor, job.finalize)
+        audio = await self.run(self.query_executor, job.audio) if success else None
+        if audio is None:
+            raise json_error(web.HTTPBadGateway, message)
+        return audio
+
+
+ENGINE_KEY = web.AppKey("engine", Engine)
+EXPIRY_KEY = web.AppKey("session_expiry", asyncio.Task)
+
+
+@web.middleware
+async def request_context(request, handler):
+    # Spans recorded while handling the request carry its session and request IDs
+    request["request_id"] = request.headers.get("X-Request-ID") or new_request_id()
+    with telemetry_context(session_id=request.match_info.get("session_id"), request_id=request["request_id"]):
+        return await handler(request)
+
+
+async def add_request_id(request, response):
+    # Set on prepare, so streamed responses carry it as well
+    if "request_id" in request:
+        response.headers["X-Request-ID"] = request["request_id"]
+
+
+async def read_json(request):
+    try:
+        body = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise json_error(web.HTTPBadRequest, "The request body must be JSON.")
+    if not isinstance(body, dict):
+        raise json_error(web.HTTPBadRequest, "The request body must be a JSON object.")
+    return body
+
+
+async def read_audio(request):
+    content_type = request.content_type if request.content_type.startswith("audio/") else "audio/wav"
+    audio = await request.read()
+    if not audio:
+        raise json_error(web.HTTPBadRequest, "The request body must contain the recorded audio.")
+    return audio, content_type
+
+
+async def create_session(request):
+    engine = request.app[ENGINE_KEY]
+    session_id = uuid.uuid4().hex
+    engine.conversations[session_id] = Conversation(session_id)
+    return web.json_response({"session_id": session_id}, status=201)
+
+
+async def delete_session(request):
+    engine = request.app[ENGINE_KEY]
+    if engine.end(request.match_info["session_id"]) is None:
+        raise json_error(web.HTTPNotFound, f"Unknown session {request.match_info['session_id']}.")
+    return web.json_response({"deleted": True})
+
+
+def validate_upload(name, data):
+    '''
+    Returns the probed file, or raises an HTTP error if it is not a readable document within the page limit
+    '''
+    if not allowed_files(name):
+        raise json_error(web.HTTPUnsupportedMediaType, f"{name} is not a valid file type.")
+    with telemetry.span("upload_validation", file=name):
+        try:
+            upload = BytesIO(data)
+            upload.name = name
+            probed_file = probe_file(upload)
+        except Exception as e:
+            logger.warning(f"Error checking file {name}: {e}")
+            raise json_error(web.HTTPBadRequest, f"{name} could not be read.")
+    if probed_file.num_pages > MAX_PAGES:
+        raise json_error(web.HTTPBadRequest, f"{name} exceeds the {MAX_PAGES}-page limit (has {probed_file.num_pages} pages).")
+    return probed_file
+
+
+async def upload_documents(request):
+    """
+    Replaces the conversation's documents with the uploaded files, as the app's file uploader does.
+    """
+    engine = request.app[ENGINE_KEY]
+    conversation = engine.conversation(request.match_info["session_id"])
+    if not request.content_type.startswith("multipart/"):
+        raise json_error(web.HTTPBadRequest, "Upload the documents as multipart/form-data.")
+
+    uploads = []
+    total = 0
+    reader = await request.multipart()
+    async for part in reader:
+        if not part.filename:
+            continue
+        data = bytearray()
+        while chunk := await part.read_chunk():
+            total += len(chunk)
+            if total > MAX_UPLOAD_BYTES:
+                raise json_error(web.HTTPRequestEntityTooLarge,
+                                 f"The documents exceed the {MAX_UPLOAD_BYTES // (1024 * 1024)} MB upload limit.",
+                                 max_size=MAX_UPLOAD_BYTES, actual_size=total)
+            data += chunk
+        uploads.append((part.filename, bytes(data)))
+    if not uploads:
+        raise json_error(web.HTTPBadRequest, "No documents were uploaded.")
+    if len(uploads) > MAX_DOCUMENTS:
+        raise json_error(web.HTTPBadRequest, f"You can only upload a maximum of {MAX_DOCUMENTS} documents.")
+
+    files = await asyncio.gather(*(engine.run(engine.ingest_executor, validate_upload, name, data)
+                                   for name, data in uploads))
+    async with conversation.lock:
+        try:
+            vector_store = await engine.run(engine.ingest_executor, update_vector_store, files,
+                                            conversation.session_id, conversation.vector_store, engine.embeddings,
+                                            engine.registry)
+        except Exception as e:
+            # update_vector_store leaves the index untouched when it fails, so the session keeps its documents
+            logger.exception(f"An error occurred while initializing the vector store: {e}")
+            raise json_error(web.HTTPBadGateway, "An error occurred while indexing the documents.")
+        if conversation.qa_chain is None or conversation.qa_chain.retriever.index is not vector_store:
+            conversation.qa_chain = build_qa_chain(vector_store, engine.llm, conversation.summary)
+        conversation.vector_store = vector_store
+        conversation.documents = [
+            {"name": file.name, "doc_id": file.digest, "pages": file.num_pages, "indexed": file.digest in vector_store}
+            for file in files
+        ]
+    failed = [document["name"] for document in conversation.documents if not document["indexed"]]
+    if failed:
+        logger.error(f"Documents could not be processed: {failed}")
+    return web.json_response({"documents": conversation.documents})
+
+
+def require_voice(voice):
+    if voice is None:
+        return DEFAULT_VOICE
+    if voice not in API_VOICES:
+        raise json_error(web.HTTPBadRequest, f"Unsupported voice, choose one of: {', '.join(sorted(API_VOICES))}.")
+    return voice
+
+
+def require_documents(conversation):
+    if conversation.vector_store is None or not conversation.vector_store.doc_ids:
+        raise json_error(web.HTTPConflict, "Kindly upload a document for me to use as context.")
+
+
+async def query(request):
+    """
+    Answers a question as JSON, or as server-sent events with "token" events followed
+    by one "answer" event when the body sets "stream": true.
+    """
+    engine = request.app[ENGINE_KEY]
+    conversation = engine.conversation(request.match_info["session_id"])
+    body = await read_json(request)
+    question = str(body.get("question", "")).strip()
+    if not question:
+        raise json_error(web.HTTPBadRequest, "The question must not be empty.")
+    require_documents(conversation)
+
+    if not body.get("stream"):
+        async with conversation.lock:
+            answer, cached = await engine.run(engine.query_executor, answer_question, question, conversation.qa_chain,
+                                              conversation.summary, engine.answer_cache)
+        return web.json_response({"answer": answer, "cached": cached})
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+
+    def event(name, data):
+        return f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+    async with conversation.lock:
+        loop = asyncio.get_running_loop()
+        tokens = asyncio.Queue()
+        answering = asyncio.ensure_future(engine.run(
+            engine.query_executor, answer_question, question, conversation.qa_chain, conversation.summary,
+            engine.answer_cache, callbacks=[TokenQueueHandler(loop, tokens)]))
+        # The tokens are queued before the answer completes, so the sentinel comes last
+        answering.add_done_callback(lambda _: tokens.put_nowait(None))
+        try:
+            while (token := await tokens.get()) is not None:
+                await response.write(event("token", {"text": token}))
+        finally:
+            # A client leaving mid-answer does not cut the turn short, the next turn needs its chat memory
+            await asyncio.wait([answering])
+        try:
+            answer, cached = answering.result()
+            await response.write(event("answer", {"answer": answer, "cached": cached}))
+        except Exception as e:
+            logger.exception(f"Error answering streamed question: {e}")
+            await response.write(event("error", {"error": "An error occurred while answering the question."}))
+    await response.write_eof()
+    return response
+
+
+async def audio_query(request):
+    """
+    Transcribes a recorded question, answers it and returns the spoken answer.
+
+    The transcript and the answer text are returned percent-encoded in the X-Transcript and X-Answer headers.
+    """
+    engine = request.app[ENGINE_KEY]
+    conversation = engine.conversation(request.match_info["session_id"])
+    voice = require_voice(request.query.get("voice"))
+    audio, content_type = await read_audio(request)
+    require_documents(conversation)
+
+    question = await transcribe(engine, audio, content_type)
+    async with conversation.lock:
+        answer, cached = await engine.run(engine.query_executor, answer_question, question, conversation.qa_chain,
+                                          conversation.summary, engine.answer_cache)
+    speech = await engine.synthesize(answer, session_id=conversation.session_id,
+                                     voice_name=voice)
+    return web.Response(body=speech, content_type=audio_mime_type(f"answer.{SPEECH_OUTPUT_FORMAT}"), headers={
+        "X-Transcript": quote(question), "X-Answer": quote(answer), "X-Answer-Cached": str(cached).lower()})
+
+
+async def transcribe(engine, audio, content_type):
+    try:
+        text = await engine.run(engine.query_executor, transcribe_audio, audio, content_type=content_type)
+    except Exception as e:
+        logger.error(f"Error processing audio input: {e}")
+        raise json_error(web.HTTPBadGateway, "An error occurred while transcribing the audio.")
+    if not text:
+        raise json_error(web.HTTPBadRequest, "Sorry, I couldn't transcribe your audio. Please try again.")
+    return text
+
+
+async def transcription(request):
+    engine = request.app[ENGINE_KEY]
+    audio, content_type = await read_audio(request)
+    return web.json_response({"text": await transcribe(engine, audio, content_type)})
+
+
+async def speech(request):
+    engine = request.app[ENGINE_KEY]
+    body = await read_json(request)
+    text = str(body.get("text", "")).strip()
+    if not text:
+        raise json_error(web.HTTPBadRequest, "The text must not be empty.")
+    voice = require_voice(body.get("voice"))
+    audio = await engine.synthesize(text, voice_name=voice)
+    return web.Response(body=audio, content_type=audio_mime_type(f"speech.{SPEECH_OUTPUT_FORMAT}"))
+
+
+async def health(request):
+    return web.json_response({"status": "ok", "sessions": len(request.app[ENGINE_KEY].conversations)})
+
+
+async def metrics(request):
+    return web.Response(text=telemetry.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+
+async def on_startup(app):
+    app[EXPIRY_KEY] = asyncio.create_task(app[ENGINE_KEY].expire_sessions())
+
+
+async def on_cleanup(app):
+    app[EXPIRY_KEY].cancel()
+    app[ENGINE_KEY].shutdown()
+
+
+def create_app(engine=None):
+    """
+    Args:
+        engine (Engine): Shared models, caches and executors; created from the environment if None.
+
+    Returns:
+        web.Application: The API application.
+    """
+    app = web.Application(middlewares=[request_context], client_max_size=MAX_UPLOAD_BYTES)
+    app[ENGINE_KEY] = engine or Engine()
+    app.add_routes([
+        web.post("/sessions", create_session),
+        web.delete("/sessions/{session_id}", delete_session),
+        web.post("/sessions/{session_id}/documents", upload_documents),
+        web.post("/sessions/{session_id}/query", query),
+        web.post("/sessions/{session_id}/audio", audio_query),
+        web.post("/transcriptions", transcription),
+        web.post("/speech", speech),
+        web.get("/health", health),
+        web.get("/metrics", metrics),
+    ])
+    app.on_response_prepare.append(add_request_id)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless HTTP API for Speak-To-Docs.")
+    parser.add_argument("--host", default=os.getenv("API_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("API_PORT", 8080)))
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='api.log', level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
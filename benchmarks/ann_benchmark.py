@@ -0,0 +1,80 @@
+"""
+Recall vs latency benchmark of the IVF retrieval engine against brute-force search.
+
+Run from the repository root:
+    python -m benchmarks.ann_benchmark --rows 200000 --dim 256
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from src.ann import ExactSearcher, IVFSearcher
+
+
+def synthetic_vectors(rows, dim, clusters, seed):
+    '''
+    Returns L2-normalised vectors drawn around random cluster centres, like embeddings of related chunks
+    '''
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centres[rng.integers(0, clusters, rows)] + 0.6 * rng.standard_normal((rows, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def time_queries(searcher, queries, k, n_probe=None):
+    results = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append([row for _, row in searcher.search(query, k, n_probe=n_probe)])
+        latencies.append(time.perf_counter() - start)
+    return results, np.array(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--n-lists", type=int, default=None)
+    parser.add_argument("--n-probe", type=int, nargs="+", default=[1, 4, 8, 16, 32],
+                        help="Lists probed per query; the searcher's default is always measured too")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Optional path to write the results as JSON")
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.rows, args.dim, clusters=max(1, args.rows // 500), seed=args.seed)
+    queries = synthetic_vectors(args.queries, args.dim, clusters=max(1, args.rows // 500), seed=args.seed + 1)
+
+    exact = ExactSearcher(vectors)
+    truth, exact_ms = time_queries(exact, queries, args.k)
+
+    start = time.perf_counter()
+    ivf = IVFSearcher(vectors, n_lists=args.n_lists)
+    build_s = time.perf_counter() - start
+
+    rows = [{"engine": "exact", "n_probe": None, "recall": 1.0,
+             "p50_ms": float(np.percentile(exact_ms, 50)), "p95_ms": float(np.percentile(exact_ms, 95))}]
+    for n_probe in sorted({*args.n_probe, ivf.default_n_probe}):
+        found, ivf_ms = time_queries(ivf, queries, args.k, n_probe=n_probe)
+        recall = np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+        rows.append({"engine": "ivf", "n_probe": n_probe, "recall": float(recall),
+                     "p50_ms": float(np.percentile(ivf_ms, 50)), "p95_ms": float(np.percentile(ivf_ms, 95))})
+
+    print(f"{args.rows} vectors x {args.dim} dims, k={args.k}, {len(ivf.centroids)} IVF lists "
+          f"(built in {build_s:.2f}s, default n_probe {ivf.default_n_probe})")
+    print(f"{'engine':<8}{'n_probe':>8}{'recall':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for row in rows:
+        print(f"{row['engine']:<8}{str(row['n_probe'] or '-'):>8}{row['recall']:>10.3f}{row['p50_ms']:>10.3f}{row['p95_ms']:>10.3f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"rows": args.rows, "dim": args.dim, "k": args.k, "build_s": build_s, "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+Deterministic local stand-ins for the Azure services used by the app, with configurable latency.
+
+`install(latencies)` must be called before `src` or `main.py` is imported: it sets
+placeholder credentials and patches the LangChain classes those modules import.
+"""
+import io
+import os
+import re
+import time
+import wave
+import zlib
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+# Simulated service latencies in milliseconds
+DEFAULT_LATENCIES = {
+    "embedding_request": 60,
+    "llm_first_token": 400,
+    "llm_token": 15,
+    "llm_summary": 500,
+    "ocr_request": 1500,
+    "ocr_page": 100,
+    "stt_request": 600,
+    "tts_request": 250,
+    "tts_per_100_chars": 80,
+}
+
+
+def _sleep(ms):
+    if ms > 0:
+        time.sleep(ms / 1000)
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Stands in for `OpenAIEmbeddings`: hashed bag-of-words vectors, so texts sharing words are similar.
+    """
+
+    def __init__(self, latencies, dim=1536, **kwargs):
+        self.latencies = latencies
+        self.dim = dim
+        self.requests = 0
+
+    def _embed(self, text):
+        vector = np.full(self.dim, 1e-3, dtype=np.float32)
+        for token in re.findall(r"\w+", text.lower()):
+            h = zlib.crc32(token.encode("utf-8"))
+            vector[h % self.dim] += 1.0 if h & 1 << 31 else -1.0
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        self.requests += 1
+        _sleep(self.latencies["embedding_request"])
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        self.requests += 1
+        _sleep(self.latencies["embedding_request"])
+        return self._embed(text)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Stands in for `ChatOpenAI`: answers with words taken from the prompt's context, streaming them token by token.
+    """
+
+    latencies: dict
+    streaming: bool = True
+    answer_words: int = 60
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _answer(self, messages):
+        prompt = messages[-1].content
+        # The instructions mention "<ctx></ctx>" too, the context block is the last one
+        context = prompt.rsplit("<ctx>", 1)[-1].split("</ctx>", 1)[0]
+        words = context.split()[:self.answer_words] or ["I", "don't", "know."]
+        return "Based on the documents, " + " ".join(words) + "."
+
+    def _generate(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager: Any = None,
+                  **kwargs: Any) -> ChatResult:
+        text = self._answer(messages)
+        _sleep(self.latencies["llm_first_token"])
+        if self.streaming and run_manager:
+            for token in re.findall(r"\S+\s*", text):
+                _sleep(self.latencies["llm_token"])
+                run_manager.on_llm_new_token(token)
+        else:
+            _sleep(self.latencies["llm_token"] * len(text.split()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+
+class _Line:
+    def __init__(self, content):
+        self.content = content
+
+
+class _Page:
+    def __init__(self, lines):
+        self.lines = [_Line(line) for line in lines]
+
+
+class _AnalyzeResult:
+    def __init__(self, pages):
+        self.pages = pages
+
+
+class FakePoller:
+    """
+    Long-running operation that completes `latency_ms` after it was started, like an LROPoller.
+    """
+
+    def __init__(self, result, latency_ms):
+        self._result = result
+        self._deadline = time.monotonic() + latency_ms / 1000
+
+    def result(self):
+        _sleep((self._deadline - time.monotonic()) * 1000)
+        return self._result
+
+
+class FakeDocumentAnalysisClient:
+    """
+    Stands in for `DocumentAnalysisClient`: "reads" every page of the PDF as synthetic text.
+    """
+
+    latencies = DEFAULT_LATENCIES
+
+    def __init__(self, endpoint=None, credential=None, **kwargs):
+        self.requests = 0
+
+    def begin_analyze_document(self, model_id, document):
+        from PyPDF2 import PdfReader
+
+        self.requests += 1
+        data = document if isinstance(document, bytes) else document.read()
+        n_pages = len(PdfReader(io.BytesIO(data)).pages)
+        pages = [_Page([f"Scanned page {i + 1} of the inspection report.",
+                        f"Valve XR-{100 + i} was replaced and tested at {20 + i} bar."]) for i in range(n_pages)]
+        latency = self.latencies["ocr_request"] + self.latencies["ocr_page"] * n_pages
+        return FakePoller(_AnalyzeResult(pages), latency)
+
+
+def wav_bytes(seconds, rate=16_000, channels=1, tone_start=None, tone_end=None):
+    '''
+    Returns a 16-bit PCM WAV file of silence with a 220 Hz tone between `tone_start` and `tone_end` seconds
+    '''
+    t = np.arange(int(seconds * rate)) / rate
+    samples = np.random.default_rng(0).normal(0, 1e-4, len(t))
+    if tone_start is not None:
+        voiced = (t >= tone_start) & (t < tone_end)
+        samples[voiced] += 0.3 * np.sin(2 * np.pi * 220 * t[voiced])
+    pcm = (np.repeat(samples[:, None], channels, axis=1) * 32767).astype("<i2")
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as output:
+        output.setnchannels(channels)
+        output.setsampwidth(2)
+        output.setframerate(rate)
+        output.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+class _SynthesisResult:
+    def __init__(self, reason, audio_data):
+        self.reason = reason
+        self.audio_data = audio_data
+
+
+class _Completed:
+    def __init__(self, result, latency_ms):
+        self._result = result
+        self._latency_ms = latency_ms
+
+    def get(self):
+        _sleep(self._latency_ms)
+        return self._result
+
+
+class FakeSpeechSynthesizer:
+    """
+    Stands in for a `SpeechSynthesizer`: returns ~60 ms of audio per character in the pooled output format.
+    """
+
+    def __init__(self, latencies, audio_format):
+        self.latencies = latencies
+        self.audio_format = audio_format
+
+    def speak_text_async(self, text):
+        import azure.cognitiveservices.speech as speechsdk
+
+        seconds = 0.06 * len(text)
+        if self.audio_format == "wav":
+            audio = wav_bytes(seconds)
+        else:
+            audio = bytes(int(seconds * 4000))  # ~32 kbit/s
+        latency = self.latencies["tts_request"] + self.latencies["tts_per_100_chars"] * len(text) / 100
+        return _Completed(_SynthesisResult(speechsdk.ResultReason.SynthesizingAudioCompleted, audio), latency)
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self._payload = payload
+        self.text = str(payload)
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._payload
+
+
+def install(latencies=None):
+    """
+    Replace every Azure client used by `src` and `main.py` with a local fake.
+
+    Args:
+        latencies (dict): Overrides of `DEFAULT_LATENCIES`.
+
+    Returns:
+        dict: The latencies in use.
+    """
+    latencies = {**DEFAULT_LATENCIES, **(latencies or {})}
+    os.environ.update({
+        "API_KEY": "benchmark", "ENDPOINT": "http://localhost", "OPENAI_API_VERSION": "2024-02-01",
+        "DOCUMENT_INTELLIGENCE_ENDPOINT": "http://localhost", "DOCUMENT_INTELLIGENCE_SUBSCRIPTION_KEY": "benchmark",
+        "SPEECH_KEY": "benchmark", "SPEECH_REGION": "local",
+    })
+
+    import langchain.chat_models
+    import langchain.embeddings
+    langchain.embeddings.OpenAIEmbeddings = lambda **kwargs: FakeEmbeddings(latencies)
+    langchain.chat_models.ChatOpenAI = lambda **kwargs: FakeChatModel(latencies=latencies,
+                                                                      streaming=kwargs.get("streaming", True))
+
+    import src.rag_functions as rag_functions
+    import src.speech_io as speech_io
+    FakeDocumentAnalysisClient.latencies = latencies
+    rag_functions.DocumentAnalysisClient = FakeDocumentAnalysisClient
+    rag_functions.chat_completion = lambda prompt, temperature=0.5: (
+        _sleep(latencies["llm_summary"]) or "The user asked about valve XR-100 and its test pressure.")
+
+    def post(url, **kwargs):
+        speech_io.speech_clients._count("http_requests")
+        _sleep(latencies["stt_request"])
+        return FakeResponse({"combinedPhrases": [{"text": "What pressure was valve XR-100 tested at?"}]})
+
+    speech_io.speech_clients.post = post
+    speech_io.speech_clients._create_synthesizer = (
+        lambda voice_name, audio_format: (FakeSpeechSynthesizer(latencies, audio_format), None))
+    return latencies
@@ -0,0 +1,275 @@
+"""
+End-to-end latency benchmark of the voice RAG pipeline with local fakes for every Azure service.
+
+Times extraction, chunking, indexing, retrieval, answering (send_response), voice
+input (handle_audio_message) and speech synthesis on synthetic PDF, PPTX and TXT
+documents of several sizes. Service latencies are simulated, see `benchmarks.fakes`.
+
+Run from the repository root:
+    python -m benchmarks.pipeline_benchmark --pages 2 10 40 --output pipeline.json
+    python -m benchmarks.pipeline_benchmark --latency llm_first_token=800 --latency ocr_request=3000
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import runpy
+import sys
+import tempfile
+import time
+import uuid
+
+os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+
+import numpy as np
+
+from benchmarks import fakes
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ("pump valve pressure inspection maintenance schedule operator safety torque seal bearing flow rate "
+         "temperature sensor calibration report manual procedure warranty filter motor housing gasket").split()
+
+
+def page_lines(doc_seed, page, n_lines=24):
+    '''
+    Returns deterministic pseudo-technical lines for one page, including part numbers such as "XR-104"
+    '''
+    rng = random.Random(doc_seed * 1000 + page)
+    lines = []
+    for i in range(n_lines):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(8, 13))]
+        if i % 6 == 0:
+            words.insert(rng.randint(0, len(words)), f"XR-{100 + page}")
+        lines.append(" ".join(words).capitalize() + ".")
+    return lines
+
+
+def make_pdf(pages):
+    '''
+    Returns a PDF with one text-layer page per list of lines; an empty list makes a scanned (image-only) page
+    '''
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>",
+               f"<< /Type /Pages /Kids [{' '.join(f'{4 + 2 * i} 0 R' for i in range(len(pages)))}] /Count {len(pages)} >>",
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    for i, lines in enumerate(pages):
+        stream = ""
+        if lines:
+            stream = "BT /F1 10 Tf 12 TL 40 760 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+
+    out = "%PDF-1.4\n"
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(out))
+        out += f"{i + 1} 0 obj\n{obj}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n" + "".join(f"{o:010d} 00000 n \n" for o in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF"
+    return out.encode("latin-1")
+
+
+def make_pptx(pages):
+    from pptx import Presentation
+
+    presentation = Presentation()
+    for i, lines in enumerate(pages):
+        slide = presentation.slides.add_slide(presentation.slide_layouts[1])
+        slide.shapes.title.text = f"Section {i + 1}"
+        slide.placeholders[1].text = "\n".join(lines)
+    buffer = io.BytesIO()
+    presentation.save(buffer)
+    return buffer.getvalue()
+
+
+def make_document(doc_type, n_pages, seed, scanned_fraction):
+    """
+    Returns:
+        tuple: (file name, file bytes) of a synthetic document.
+    """
+    pages = [page_lines(seed, page) for page in range(n_pages)]
+    if doc_type == "pdf":
+        scanned = set(random.Random(seed).sample(range(n_pages), int(n_pages * scanned_fraction)))
+        return f"doc{seed}.pdf", make_pdf([[] if i in scanned else lines for i, lines in enumerate(pages)])
+    if doc_type == "pptx":
+        return f"doc{seed}.pptx", make_pptx(pages)
+    return f"doc{seed}.txt", "\n\n".join("\n".join(lines) for lines in pages).encode("utf-8")
+
+
+class Upload(io.BytesIO):
+    """
+    In-memory stand-in for a Streamlit UploadedFile.
+    """
+
+    def __init__(self, name, data, mime_type="application/octet-stream"):
+        super().__init__(data)
+        self.name = name
+        self.type = mime_type
+
+    def getbuffer(self):
+        return memoryview(self.getvalue())
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def summarize(stage, runs_ms, **labels):
+    runs = np.array(runs_ms)
+    return {"stage": stage, **labels, "runs": len(runs), "runs_ms": [round(float(r), 3) for r in runs],
+            "p50_ms": float(np.percentile(runs, 50)), "p95_ms": float(np.percentile(runs, 95)),
+            "mean_ms": float(runs.mean())}
+
+
+def new_session(st):
+    for key in list(st.session_state.keys()):
+        del st.session_state[key]
+    st.session_state.session_id = uuid.uuid4().hex
+    st.session_state.messages = []
+    st.session_state.speech_outputs = []
+
+
+def benchmark_document(app, st, rag_functions, speech_io, doc_type, n_pages, seed, args):
+    results = []
+    labels = {"doc_type": doc_type, "pages": n_pages}
+    name, data = make_document(doc_type, n_pages, seed, args.scanned_fraction)
+    probed = rag_functions.probe_file(Upload(name, data))
+
+    # Extraction, cold (fresh extraction cache) then warm
+    cold = []
+    for _ in range(args.repeat):
+        cache_dir = tempfile.mkdtemp(prefix="extract-", dir=".")
+        pages, ms = timed(lambda: list(rag_functions.extract_contents_from_doc([probed], cache_dir))[0])
+        cold.append(ms)
+    results.append(summarize("extract_contents_from_doc", cold, cache="cold", **labels))
+    warm = [timed(lambda: list(rag_functions.extract_contents_from_doc([probed], cache_dir))[0])[1]
+            for _ in range(args.repeat)]
+    results.append(summarize("extract_contents_from_doc", warm, cache="warm", **labels))
+
+    text = "\n".join(pages)
+    runs = [timed(rag_functions.chunk_document, text)[1] for _ in range(args.repeat)]
+    results.append(summarize("chunk_document", runs, chars=len(text), **labels))
+
+    # Indexing: the first session embeds the document, a second session reuses the shared segment
+    new_session(st)
+    vector_store, ms = timed(app["create_vector_store"], [probed], st.session_state.session_id)
+    results.append(summarize("create_vector_store", [ms], cache="cold", chunks=len(vector_store), **labels))
+    shared = []
+    for _ in range(args.repeat):
+        _, ms = timed(app["create_vector_store"], [probed], uuid.uuid4().hex)
+        shared.append(ms)
+    results.append(summarize("create_vector_store", shared, cache="shared segment", **labels))
+
+    questions = [f"What does the manual say about {a} and {b}?" for a, b in zip(WORDS[::2], WORDS[1::2])]
+    st.session_state.conversation = rag_functions.RollingSummary()
+    qa_stuff = app["build_qa_chain"](vector_store)
+    runs = [timed(qa_stuff.retriever.invoke, question)[1] for question in questions[:args.repeat]]
+    results.append(summarize("retrieval", runs, mode="hybrid", **labels))
+    runs = [timed(qa_stuff.retriever.invoke, f"XR-{100 + i % n_pages}")[1] for i in range(args.repeat)]
+    results.append(summarize("retrieval", runs, mode="identifier", **labels))
+
+    # Answering in a session with the document uploaded; speech synthesis continues in the background
+    st.session_state.vector_store = vector_store
+    st.session_state.qa_stuff = qa_stuff
+    runs = [timed(app["send_response"], question)[1] for question in questions[args.repeat:2 * args.repeat]]
+    results.append(summarize("send_response", runs, answer_cache="miss", **labels))
+    runs = []
+    for _ in range(args.repeat):
+        # The answer cache only serves the first turn of a conversation, so each hit is a new session's
+        st.session_state.conversation = rag_functions.RollingSummary()
+        st.session_state.qa_stuff = app["build_qa_chain"](vector_store)
+        runs.append(timed(app["send_response"], questions[args.repeat])[1])
+    results.append(summarize("send_response", runs, answer_cache="hit", **labels))
+
+    recording = fakes.wav_bytes(4.0, rate=48_000, channels=2, tone_start=1.0, tone_end=2.5)
+    runs = []
+    for _ in range(args.repeat):
+        st.session_state.audio_prompt = Upload("recording.wav", recording, "audio/wav")
+        runs.append(timed(app["handle_audio_message"])[1])
+    results.append(summarize("handle_audio_message", runs, recording_bytes=len(recording), **labels))
+
+    # Speech synthesis of a fresh answer: time to the first playable sentence and to the joined file
+    answer = " ".join(page_lines(seed + 7919, 0, n_lines=6))
+    first, total = [], []
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        job = speech_io.SpeechJob(f"{answer} Run {i}.", f"{uuid.uuid4().hex}.{speech_io.SPEECH_OUTPUT_FORMAT}")
+        while not job.ready_segments() and not job.done():
+            time.sleep(0.005)
+        first.append((time.perf_counter() - start) * 1000)
+        while not job.done():
+            time.sleep(0.005)
+        job.finalize()
+        total.append((time.perf_counter() - start) * 1000)
+    results.append(summarize("speech_synthesis", first, milestone="first segment", chars=len(answer), **labels))
+    results.append(summarize("speech_synthesis", total, milestone="joined", chars=len(answer), **labels))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--doc-types", nargs="+", default=["pdf", "pptx", "txt"], choices=["pdf", "pptx", "txt"])
+    parser.add_argument("--pages", type=int, nargs="+", default=[2, 10, 40])
+    parser.add_argument("--scanned-fraction", type=float, default=0.25, help="Share of PDF pages without a text layer")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", action="append", default=[], metavar="NAME=MS",
+                        help=f"Override a simulated latency, one of: {', '.join(fakes.DEFAULT_LATENCIES)}")
+    parser.add_argument("--output", help="Optional path to write the results as JSON")
+    args = parser.parse_args()
+
+    overrides = {}
+    for item in args.latency:
+        key, _, value = item.partition("=")
+        if key not in fakes.DEFAULT_LATENCIES:
+            parser.error(f"Unknown latency: {key}")
+        overrides[key] = float(value)
+    output = os.path.abspath(args.output) if args.output else None
+
+    # Every cache and index the app writes goes to a scratch directory
+    work_dir = tempfile.mkdtemp(prefix="speak-to-docs-benchmark-")
+    os.chdir(work_dir)
+    sys.path.insert(0, REPO_ROOT)
+
+    latencies = fakes.install(overrides)
+    import streamlit as st
+    import src.rag_functions as rag_functions
+    import src.speech_io as speech_io
+
+    app = runpy.run_path(os.path.join(REPO_ROOT, "main.py"), run_name="speak_to_docs")
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = []
+    seed = 0
+    for doc_type in args.doc_types:
+        for n_pages in args.pages:
+            seed += 1
+            print(f"Benchmarking {doc_type} with {n_pages} page(s)...", file=sys.stderr)
+            results.extend(benchmark_document(app, st, rag_functions, speech_io, doc_type, n_pages, seed, args))
+
+    print(f"{'stage':<28}{'doc':>6}{'pages':>7}  {'variant':<16}{'p50 ms':>10}{'p95 ms':>10}")
+    for row in results:
+        variant = row.get("cache") or row.get("mode") or row.get("answer_cache") or row.get("milestone") or ""
+        print(f"{row['stage']:<28}{row['doc_type']:>6}{row['pages']:>7}  {variant:<16}"
+              f"{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}")
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "config": {"doc_types": args.doc_types, "pages": args.pages, "repeat": args.repeat,
+                           "scanned_fraction": args.scanned_fraction, "latencies_ms": latencies},
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
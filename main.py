@@ -2,17 +2,18 @@ import streamlit as st
 import os
 import logging
 from dotenv import load_dotenv
-from src.speech_io import transcribe_audio, synthesize_speech
-from src.rag_functions import (allowed_files, file_check_num, 
-                               extract_contents_from_doc, chunk_document, logger, get_conversation_summary)
-from langchain.embeddings import OpenAIEmbeddings
-from langchain_community.vectorstores import DocArrayInMemorySearch
-from langchain.schema import Document
+from src.speech_io import transcribe_audio, SpeechJob, cancel_session_synthesis, speech_clients, SPEECH_OUTPUT_FORMAT, audio_mime_type
+from src.rag_functions import (allowed_files, probe_file, logger, RollingSummary,
+                               StreamingAnswerHandler)
+from src.embedding_cache import CachedEmbeddings
+from src.answer_cache import SemanticAnswerCache
+from src.segment_registry import SegmentRegistry
+from src.pipeline import (create_llm, create_embeddings, create_answer_cache, create_segment_registry,
+                          update_vector_store, answer_question)
+from src.pipeline import build_qa_chain as pipeline_qa_chain
+from src.telemetry import telemetry, session_id_var, new_request_id
+from src.telemetry import context as telemetry_context
 from langchain.chat_models import ChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.memory import ConversationBufferWindowMemory
-from langchain import PromptTemplate
-import openai
 import uuid
 
 # Set up page configuration
@@ -31,24 +32,7 @@ load_dotenv()
 @st.cache_resource
 def get_llm() -> ChatOpenAI:
     try:
-        # Configure OpenAI API using Azure OpenAI
-        openai.api_key = os.getenv("API_KEY")
-        openai.api_base = os.getenv("ENDPOINT")
-        openai.api_type = "azure"
-        openai.api_version = os.getenv("OPENAI_API_VERSION")
-        
-        # # OpenAI Settings
-        # openai_embeddings = OpenAIEmbeddings(
-        #     openai_api_version=os.getenv("OPENAI_API_VERSION"), 
-        #     openai_api_key=os.getenv("API_KEY"),
-        #     openai_api_base=os.getenv("ENDPOINT"), 
-        #     openai_api_type="azure"
-        # )
-        
-        llm = ChatOpenAI(
-            temperature=0.3, openai_api_key=os.getenv("API_KEY"), 
-            openai_api_base=os.getenv("ENDPOINT"), model_name="gpt-35-turbo", engine="Voicetask"
-        )
+        llm = create_llm()
         
         logging.info("LLM initialized successfully.")
         return llm
@@ -59,73 +43,92 @@ def get_llm() -> ChatOpenAI:
 
 llm = get_llm()
 
+# Warm up pooled speech synthesizers once per process so the first answer skips client setup
+@st.cache_resource
+def warm_speech_clients():
+    if not os.getenv("SPEECH_KEY") or not os.getenv("SPEECH_REGION"):
+        return
+    try:
+        speech_clients.warm_up("en-NG-EzinneNeural", count=2)
+        logging.info("Speech synthesizers warmed up.")
+    except Exception as e:
+        logging.warning(f"Error warming up speech synthesizers: {e}")
+
+warm_speech_clients()
+
+# Initialize the embeddings model, shared by all sessions so cached vectors and the TPM budget are shared too
+@st.cache_resource
+def get_embeddings() -> CachedEmbeddings:
+    return create_embeddings()
+
+# Answers to earlier questions about the same documents, shared by all sessions
+@st.cache_resource
+def get_answer_cache() -> SemanticAnswerCache:
+    return create_answer_cache()
+
+# Loaded index segments, shared read-only by all sessions that upload the same document
+@st.cache_resource
+def get_segment_registry() -> SegmentRegistry:
+    return create_segment_registry()
+
+# Expose per-stage latency metrics for Prometheus once per process, if a port is configured
+@st.cache_resource
+def start_metrics_server():
+    port = os.getenv("METRICS_PORT")
+    if not port:
+        return None
+    try:
+        return telemetry.serve(int(port))
+    except Exception as e:
+        logging.warning(f"Error starting the metrics server: {e}")
+
+start_metrics_server()
+
 #function to embed the chunks created on docs and initializing a vector store
-def create_vector_store(extracted_file_paths):
+def create_vector_store(files, session_id, vector_store=None):
     """
-    Embeds the documents and initializes a DocArrayInMemorySearch vector store.
+    Brings the session's vector store in line with the uploaded documents, see `update_vector_store`,
+    reporting the embedding progress of each new document in the sidebar.
 
     Args:
-        extracted_file_path: A path containing the contents extracted from the documents uploaded
+        files: The validated documents uploaded by the user, as ProbedFile objects
+        session_id: ID of the session, used to reference count the shared segments
+        vector_store: The session's current VectorIndex, a new one is created if None
 
     Returns:
-        DocArrayInMemorySearch: An initialized vector store with embedded documents.
+        VectorIndex: A vector store over the embedded documents.
     """
     try:
-        #OpenAI Embedding settings
-        openai_embeddings = OpenAIEmbeddings(
-                openai_api_version=os.getenv("OPENAI_API_VERSION"), 
-                openai_api_key=os.getenv("API_KEY"),
-                openai_api_base=os.getenv("ENDPOINT"), 
-                openai_api_type="azure",
-                deployment="text-embedding-ada-002"
-            )
-        logger.info("OpenAI Embeddings initialized successfully.")
-        docs = []
-        for file_path in extracted_file_paths:
-            try:
-                with open(file_path, "r", encoding="utf-8") as file:
-                    text = file.read()
-                chunks = chunk_document(text)
-                docs.extend([Document(page_content=chunk) for chunk in chunks])
-                logger.info(f"Document {file_path} chunked into {len(chunks)} chunks.")
-            except Exception as e:
-                logger.error(f"Error reading or chunking file '{file_path}': {e}")
-                continue
-
-        #initializing the vector store
-        vector_store = DocArrayInMemorySearch.from_documents(docs, openai_embeddings)
-        logger.info("DocArrayInMemorySearch vector store initialized successfully.")
-
+        progress_bars = {}
+        def show_progress(file, done, total):
+            if file.digest not in progress_bars:
+                progress_bars[file.digest] = st.progress(0.0, text=f"Embedding {file.name}...")
+            progress_bars[file.digest].progress(done / total if total else 1.0,
+                                                text=f"Embedding {file.name} ({done}/{total} chunks)...")
+
+        #OpenAI Embedding settings, only chunks missing from the embedding cache reach Azure
+        vector_store = update_vector_store(files, session_id, vector_store, get_embeddings(), get_segment_registry(),
+                                           progress=show_progress)
+        for progress_bar in progress_bars.values():
+            progress_bar.empty()
         return vector_store
     
     except Exception as e:
         logger.exception(f"An error occurred while initializing the vector store: {e}")
 
-# Prompt Template
-prompt = """
-Use the following context (delimited by <ctx></ctx>) and the chat history (delimited by <hs></hs>) to answer the user's question. 
-If you don't know the answer, just say that you don't know, don't try to make up an answer.
-------
-<ctx>
-{context}
-</ctx>
-------
-<hs>
-{history}
-</hs>
-------
-{question}
-Answer:
-"""
-prompt = PromptTemplate(
-    input_variables=["history", "context", "question"],
-    template=prompt,
-)
-
-# Retrieval QA
-from langchain.chains import RetrievalQA
+def build_qa_chain(vector_store):
+    return pipeline_qa_chain(vector_store, llm, st.session_state.conversation)
 
 # Sidebar configuration for file uploads
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+# Spans recorded during this run carry the session's ID
+session_id_var.set(st.session_state.session_id)
+
+# The conversation's rolling summary is the chat history of its QA chain
+if 'conversation' not in st.session_state:
+    st.session_state.conversation = RollingSummary()
+
 if 'uploaded_files' not in st.session_state:
     st.session_state.uploaded_files = None
     st.session_state['prev_uploaded_files'] = []
@@ -155,14 +158,21 @@ with st.sidebar:
                 valid_file = True
                 for file in uploaded_files:
                     if allowed_files(file.name):
-                        num_pages = file_check_num(file)
-                        if num_pages > 50:
-                            st.error(f"{file.name} exceeds the 50-page limit (has {num_pages} pages).")
+                        try:
+                            with telemetry.span("upload_validation", file=file.name):
+                                probed_file = probe_file(file)
+                        except Exception as e:
+                            st.error(f"{file.name} could not be read.")
+                            logging.warning(f"Error checking file {file.name}: {e}")
+                            valid_file = False
+                            break
+                        if probed_file.num_pages > 50:
+                            st.error(f"{file.name} exceeds the 50-page limit (has {probed_file.num_pages} pages).")
                             logging.warning(f"File {file.name} exceeds the page limit.")
                             valid_file = False
                             break
                         else:
-                            valid_files.append(file)
+                            valid_files.append(probed_file)
                     else:
                         st.error(f"{file.name} is not a valid file type.")
                         logging.warning(f"Invalid file type: {file.name}")
@@ -171,30 +181,21 @@ with st.sidebar:
 
                 if valid_file and valid_files:
                     try:
-                        extraction_results = extract_contents_from_doc(valid_files, "temp_dir")
-                        vector_store = create_vector_store(extraction_results)
-                        if vector_store:
+                        # Only documents added since the last upload are embedded
+                        vector_store = create_vector_store(valid_files, st.session_state.session_id,
+                                                           st.session_state.get('vector_store'))
+                        if vector_store is not None:
                             st.session_state['vector_store'] = vector_store
                             st.success(f"{len(uploaded_files)} file(s) uploaded and processed successfully.")
                             logging.info("File(s) uploaded and processed successfully.")
-                        
-                        # Initialize session state for qa_stuff
-                        if 'qa_stuff' not in st.session_state:
-                            retriever = vector_store.as_retriever(search_kwargs={'k': 3})
-                            st.session_state.qa_stuff = RetrievalQA.from_chain_type(
-                                                            llm = llm, 
-                                                            chain_type = "stuff", 
-                                                            retriever = retriever, 
-                                                            verbose = False,
-                                                            chain_type_kwargs = {
-                                                                "verbose": True,
-                                                                "prompt": prompt,
-                                                                "memory": ConversationBufferWindowMemory(
-                                                                        k = 10,
-                                                                        memory_key = "history",
-                                                                        input_key = "question")
-                                                                        }
-                                                            )
+
+                            # Initialize session state for qa_stuff, its retriever always queries the current index
+                            if 'qa_stuff' not in st.session_state or st.session_state.qa_stuff.retriever.index is not vector_store:
+                                st.session_state.qa_stuff = build_qa_chain(vector_store)
+                        else:
+                            # The session keeps its previous documents, the upload is processed again on the next rerun
+                            st.session_state['prev_uploaded_files'] = []
+                            st.error("An error occurred while processing your document. Please try again.")
 
                     except Exception as e:
                         st.error("An error occurred while processing your document. Please try again.")
@@ -202,53 +203,60 @@ with st.sidebar:
     else:
         st.session_state.uploaded_files = None
         st.session_state['prev_uploaded_files'] = []
+        if 'vector_store' in st.session_state:
+            for doc_id in st.session_state.vector_store.doc_ids:
+                st.session_state.vector_store.remove(doc_id)
+            get_segment_registry().release_session(st.session_state.session_id)
         
-    st.subheader("Speech output responses")
-    if 'speech_outputs' in st.session_state:
-        for speech_output in st.session_state.speech_outputs:
-            st.audio(os.path.join('speech_outputs', speech_output), format="audio/wav", start_time=0)
+def speak_response(text):
+    # synthesize sentence by sentence in the background so the sidebar can play
+    # the first sentences while the rest is rendered
+    # generate unique file name
+    output_file = f"{uuid.uuid4().hex}.{SPEECH_OUTPUT_FORMAT}"
+    job = SpeechJob(text, output_file, session_id=st.session_state.session_id)
+    st.session_state.speech_outputs.append(job)
 
 def send_response(message, response=None):
+    # a voice turn keeps the request ID its transcription was recorded under
+    request_id = st.session_state.pop('pending_request_id', None) or new_request_id()
+    with telemetry_context(session_id=st.session_state.session_id, request_id=request_id):
+        answer_message(message, response)
+    logger.info(f"Stage latencies: {telemetry.summary()}")
+
+def answer_message(message, response=None):
     dummy_response = None
-    if 'qa_stuff' not in st.session_state:
+    if 'qa_stuff' not in st.session_state or not st.session_state.vector_store.doc_ids:
         dummy_response = "Kindly upload a document for me to use as context."
 
     if not response and not dummy_response:
-        # # Advanced RAG Model
-        # full_history = ""
-        # for role, text in st.session_state.messages[:10]:
-        #     full_history += "Human: " + text + "\n" if role == "user" else "AI: " + text + "\n"
-
-        # # full_history = st.session_state.history
-        # print("Full History: ", st.session_state.messages)
-        # print("History: ", full_history)
-        # if len(st.session_state.messages) > 0:
-        #     message = get_conversation_summary(full_history, message)
-  
-
-        response = st.session_state.qa_stuff.run(message)
+        # stream tokens into the chat as they arrive, the final text is handed to TTS
+        handler = StreamingAnswerHandler(st.empty(), on_complete=speak_response)
+        response, cached = answer_question(message, st.session_state.qa_stuff, st.session_state.conversation,
+                                           get_answer_cache(), callbacks=[handler])
+        if cached:
+            # near-identical questions about the same documents reuse the stored answer and its audio
+            st.write(response)
+            speak_response(response)
+    else:
+        st.write(response or dummy_response)
+        speak_response(response or dummy_response)
         
     st.session_state.messages.append(('assistant', response or dummy_response))
     
-    # TODO: make async ??
-    # generate unique file name
-    output_file = uuid.uuid4().hex + ".wav"
-    synthesize_speech(output_file=output_file, text=response or dummy_response)
-    st.session_state.speech_outputs.append(output_file)
-    
 
 # Chat area and audio input handling
 def send_message():
     prompt = st.session_state.prompt
     st.session_state.messages.append(('user', prompt))
     
-    # get response turn it to speech and reply user
-    send_response(prompt)
+    # the response is streamed into the chat below the message history
+    st.session_state.pending_response = (prompt, None)
+    st.session_state.pending_request_id = None
 
 
 if 'messages' not in st.session_state:
     st.session_state.messages = []
-    
+
 if 'speech_outputs' not in st.session_state:
     st.session_state.speech_outputs = []
 
@@ -260,18 +268,22 @@ message = st.container()
 
 def handle_audio_message():
     audio_value = st.session_state.audio_prompt
+    if audio_value is None:
+        # The recording was cleared
+        return
     try:
-        with open("audio.wav", "wb") as f:
-            f.write(audio_value.getbuffer())
-        
-        speech_text = transcribe_audio("audio.wav")
+        # Send the recording from memory, so concurrent sessions never share a file
+        request_id = new_request_id()
+        with telemetry_context(session_id=st.session_state.session_id, request_id=request_id):
+            speech_text = transcribe_audio(audio_value.getbuffer(), content_type=audio_value.type or "audio/wav")
+        st.session_state.pending_request_id = request_id
         if speech_text:
             st.session_state.messages.append(("user", speech_text))
-            send_response(speech_text)
+            st.session_state.pending_response = (speech_text, None)
             logging.info("Audio transcribed successfully.")
         else:
             # st.session_state.messages.append(("assistant", ))
-            send_response(speech_text, "Sorry, I couldn't transcribe your audio. Please try again.")
+            st.session_state.pending_response = (speech_text, "Sorry, I couldn't transcribe your audio. Please try again.")
             logging.warning("Audio transcription failed.")
     except Exception as e:
         st.error("An error occurred while processing the audio. Please try again.")
@@ -286,7 +298,47 @@ st.chat_input("Enter your query", key='prompt', on_submit=send_message)
 # with message:
 for role, text in st.session_state.messages:
     st.chat_message(role).write(text)
+
+# get response turn it to speech and reply user
+if st.session_state.get('pending_response'):
+    question, response = st.session_state.pending_response
+    st.session_state.pending_response = None
+    with st.chat_message('assistant'):
+        send_response(question, response)
     
 
 # Handle audio input from user
 audio_value = st.experimental_audio_input("Record a voice message", key="audio_prompt", on_change=handle_audio_message)
+
+# Speech output area, rendered last so it picks up the job of the answer above
+with st.sidebar:
+    st.subheader("Speech output responses")
+    if 'speech_outputs' in st.session_state:
+        # Poll for finished clips only while synthesis jobs are pending
+        # Clips deleted by the retention quotas are dropped together with their cached bytes
+        st.session_state.speech_outputs = [job for job in st.session_state.speech_outputs if not job.evicted()]
+        pending_speech = not all(job.done() for job in st.session_state.speech_outputs)
+
+        @st.fragment(run_every=1.0 if pending_speech else None)
+        def speech_outputs_panel():
+            pending = False
+            for job in st.session_state.speech_outputs:
+                if job.done():
+                    # The finished clip is read from disk once and served from memory on later reruns
+                    audio = job.audio()
+                    if audio is not None:
+                        st.audio(audio, format=audio_mime_type(job.output_file), start_time=0)
+                else:
+                    # Sentences that are already synthesized can be played while the rest is rendered
+                    pending = True
+                    for segment_file in job.ready_segments():
+                        st.audio(os.path.join('speech_outputs', segment_file), format=audio_mime_type(segment_file), start_time=0)
+            if pending:
+                st.caption("Synthesizing audio...")
+                if st.button("Stop pending audio"):
+                    cancel_session_synthesis(st.session_state.session_id)
+            elif pending_speech:
+                # Rerun the whole script so the fragment stops polling
+                st.rerun()
+
+        speech_outputs_panel()
@@ -0,0 +1,155 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Stores smaller than this are searched exactly, an IVF index does not pay off below it
+EXACT_SEARCH_THRESHOLD = 20_000
+# Share of the inverted lists probed per query when no n_probe is given, higher is slower but gives better recall
+N_PROBE_FRACTION = 0.05
+# Fewest lists probed per query, small indexes need a larger share of their lists for the same recall
+MIN_N_PROBE = 32
+
+
+def top_k(scores, k):
+    '''
+    Returns the positions of the `k` highest scores, best first
+    '''
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class ExactSearcher:
+    """
+    Brute-force inner product search over L2-normalised vectors.
+    """
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def search(self, query_vector, k, n_probe=None):
+        """
+        Returns:
+            list[tuple[float, int]]: The `k` best (score, row) pairs, best first.
+        """
+        if len(self.vectors) == 0:
+            return []
+        scores = self.vectors @ query_vector
+        return [(float(scores[i]), int(i)) for i in top_k(scores, k)]
+
+
+class IVFSearcher:
+    """
+    Inverted file index: rows are clustered with spherical k-means and a query only
+    scores the rows in the `n_probe` clusters whose centroids are closest to it.
+
+    By default 5% of the lists are probed, at least `MIN_N_PROBE`. On 50k x 128 synthetic
+    vectors (894 lists, k=3, see benchmarks/ann_benchmark.py) that is 45 lists for a
+    recall@3 of ~0.97 at ~0.7 ms p50, against ~3.8 ms for exact search; 8 lists is 5x
+    faster still but recalls only ~0.67 of the true neighbours.
+
+    The inverted lists are stored as one array of row ids sorted by cluster plus
+    an offsets array (CSR layout), so the index adds ~8 bytes per row.
+
+    Args:
+        vectors (np.ndarray): L2-normalised float32 matrix, may be memory-mapped.
+        n_lists (int): Number of clusters, defaults to ~4 * sqrt(rows).
+        iterations (int): k-means iterations.
+        seed (int): Seed for the k-means initialisation.
+    """
+
+    def __init__(self, vectors, n_lists=None, iterations=10, seed=0, centroids=None, ids=None, offsets=None):
+        self.vectors = vectors
+        if centroids is None:
+            centroids, ids, offsets = self._train(vectors, n_lists, iterations, seed)
+        self.centroids = centroids
+        self.ids = ids
+        self.offsets = offsets
+        self.default_n_probe = max(MIN_N_PROBE, int(np.ceil(N_PROBE_FRACTION * len(centroids))))
+
+    @staticmethod
+    def _assign(vectors, centroids, batch_size=65_536):
+        assignments = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), batch_size):
+            batch = np.asarray(vectors[start:start + batch_size])
+            assignments[start:start + batch_size] = np.argmax(batch @ centroids.T, axis=1)
+        return assignments
+
+    @classmethod
+    def _train(cls, vectors, n_lists, iterations, seed):
+        n = len(vectors)
+        n_lists = max(1, min(n, n_lists or int(4 * np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+
+        # Train on a sample, k-means quality saturates long before it sees every row
+        sample_size = min(n, n_lists * 64)
+        sample = np.asarray(vectors[np.sort(rng.choice(n, sample_size, replace=False))])
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            counts = np.bincount(assignments, minlength=n_lists)
+            # Sum each cluster's rows with one sort + reduceat rather than a slow np.add.at scatter
+            order = np.argsort(assignments, kind="stable")
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            sums = np.zeros_like(centroids)
+            present = counts > 0
+            sums[present] = np.add.reduceat(sample[order], starts[present], axis=0)
+            empty = counts == 0
+            # Re-seed empty clusters with random sample rows
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+
+        assignments = cls._assign(vectors, centroids)
+        ids = np.argsort(assignments, kind="stable").astype(np.int64)
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=offsets[1:])
+        logger.info(f"Trained IVF index with {n_lists} lists over {n} vectors.")
+        return centroids, ids, offsets
+
+    def search(self, query_vector, k, n_probe=None):
+        """
+        Args:
+            n_probe (int): Lists to probe, defaults to `default_n_probe`.
+
+        Returns:
+            list[tuple[float, int]]: Approximately the `k` best (score, row) pairs, best first.
+        """
+        n_probe = min(n_probe or self.default_n_probe, len(self.centroids))
+        lists = top_k(self.centroids @ query_vector, n_probe)
+        candidates = np.concatenate([self.ids[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+        if len(candidates) == 0:
+            return []
+        candidates.sort()  # sequential access into a memory-mapped matrix
+        scores = np.asarray(self.vectors[candidates]) @ query_vector
+        return [(float(scores[i]), int(candidates[i])) for i in top_k(scores, k)]
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, ids=self.ids, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path, vectors):
+        data = np.load(path)
+        return cls(vectors, centroids=data["centroids"], ids=data["ids"], offsets=data["offsets"])
+
+
+def build_searcher(vectors, engine="auto", exact_threshold=EXACT_SEARCH_THRESHOLD, **params):
+    """
+    Returns a searcher for `vectors`.
+
+    Args:
+        vectors (np.ndarray): L2-normalised float32 matrix.
+        engine (str): "exact", "ivf", or "auto" to use IVF only for stores with at least `exact_threshold` rows.
+        params: Extra arguments for `IVFSearcher`.
+    """
+    if engine == "exact" or (engine == "auto" and len(vectors) < exact_threshold):
+        return ExactSearcher(vectors)
+    if engine in ("ivf", "auto"):
+        return IVFSearcher(vectors, **params)
+    raise ValueError(f"Unknown search engine: {engine}")
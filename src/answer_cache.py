@@ -0,0 +1,109 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Minimum cosine similarity between two questions for one to reuse the other's answer
+ANSWER_CACHE_THRESHOLD = 0.97
+ANSWER_CACHE_TTL = 24 * 60 * 60
+ANSWER_CACHE_MAX_ENTRIES = 5_000
+
+
+def document_set_hash(doc_ids):
+    '''
+    Returns a hash identifying a set of indexed documents, independent of upload order
+    '''
+    return hashlib.sha256("\0".join(sorted(doc_ids)).encode("utf-8")).hexdigest()
+
+
+class SemanticAnswerCache:
+    """
+    Process-wide cache of answers, keyed by the uploaded document set and the embedding of the question.
+
+    A question reuses a stored answer when it was asked about the same documents and
+    its embedding has a cosine similarity of at least `threshold` with the stored
+    question. Entries expire after `ttl` seconds and the least recently used ones are
+    dropped beyond `max_entries`. A reused answer has the same text as the original,
+    so its audio is also served by the speech cache.
+
+    Args:
+        threshold (float): Minimum cosine similarity for a hit.
+        ttl (float): Lifetime of an entry in seconds.
+        max_entries (int): Maximum number of stored answers.
+    """
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (doc set, question) -> (normalised vector, answer, stored at), LRU order
+        self._doc_sets = defaultdict(set)  # doc set -> keys of its entries
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        del self._entries[key]
+        self._doc_sets[key[0]].discard(key)
+        if not self._doc_sets[key[0]]:
+            del self._doc_sets[key[0]]
+
+    def get(self, doc_set, query_vector):
+        """
+        Args:
+            doc_set (str): Hash of the document set, see `document_set_hash`.
+            query_vector (np.ndarray): L2-normalised embedding of the question.
+
+        Returns:
+            str: The answer to the most similar stored question, or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            keys = []
+            for key in list(self._doc_sets.get(doc_set, ())):
+                if now - self._entries[key][2] > self.ttl:
+                    self._remove(key)
+                else:
+                    keys.append(key)
+
+            best_key, best_score = None, 0.0
+            if keys:
+                scores = np.stack([self._entries[key][0] for key in keys]) @ query_vector
+                best = int(np.argmax(scores))
+                best_key, best_score = keys[best], float(scores[best])
+
+            if best_key is None or best_score < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_key)
+            logger.info(f"Answer cache hit for a question similar to {best_key[1]!r} (similarity {best_score:.3f}).")
+            return self._entries[best_key][1]
+
+    def put(self, doc_set, question, query_vector, answer):
+        """
+        Stores the answer to `question` about the document set `doc_set`.
+        """
+        with self._lock:
+            key = (doc_set, question)
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (np.asarray(query_vector, dtype=np.float32), answer, time.time())
+            self._doc_sets[doc_set].add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+            }
@@ -0,0 +1,129 @@
+import io
+import logging
+import time
+import wave
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Fast transcription works on 16 kHz mono, anything above that is uploaded for nothing
+TARGET_SAMPLE_RATE = 16_000
+# Length of the frames whose energy decides whether they contain speech
+VAD_FRAME_MS = 30
+# Frames quieter than the loudest frame by more than this are treated as silence
+VAD_DYNAMIC_RANGE_DB = 40.0
+# Absolute floor for speech, so a silent recording is not "trimmed" down to its noise
+VAD_MIN_LEVEL_DBFS = -55.0
+# Silence kept before and after the detected speech, so word onsets are not clipped
+VAD_PADDING_MS = 200
+
+
+def decode_wav(data):
+    '''
+    Returns the samples of a PCM WAV file as a float32 (frames, channels) array in [-1, 1] and its sample rate
+    '''
+    with wave.open(io.BytesIO(data), "rb") as wav:
+        channels = wav.getnchannels()
+        width = wav.getsampwidth()
+        rate = wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+
+    if width == 1:
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif width == 2:
+        samples = np.frombuffer(frames, dtype="<i2").astype(np.float32) / 32768
+    elif width == 3:
+        raw = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        values = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        values[values >= 1 << 23] -= 1 << 24
+        samples = values.astype(np.float32) / (1 << 23)
+    elif width == 4:
+        samples = np.frombuffer(frames, dtype="<i4").astype(np.float32) / 2 ** 31
+    else:
+        raise ValueError(f"Unsupported sample width: {width} bytes")
+    return samples.reshape(-1, channels), rate
+
+
+def encode_wav(samples, rate):
+    '''
+    Returns mono float32 samples as a 16-bit PCM WAV file
+    '''
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2")
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+def trim_silence(samples, rate):
+    '''
+    Returns mono `samples` without the leading and trailing silence, found from the energy of short frames
+    '''
+    frame = max(1, rate * VAD_FRAME_MS // 1000)
+    n_frames = len(samples) // frame
+    if n_frames == 0:
+        return samples
+
+    energy = np.mean(samples[:n_frames * frame].reshape(n_frames, frame) ** 2, axis=1)
+    level = 10 * np.log10(energy + 1e-12)
+    threshold = max(level.max() - VAD_DYNAMIC_RANGE_DB, VAD_MIN_LEVEL_DBFS)
+    voiced = np.flatnonzero(level >= threshold)
+    if len(voiced) == 0:
+        # Nothing sounds like speech, let the service decide
+        return samples
+
+    padding = rate * VAD_PADDING_MS // 1000
+    start = max(0, voiced[0] * frame - padding)
+    end = min(len(samples), (voiced[-1] + 1) * frame + padding)
+    return samples[start:end]
+
+
+def resample(samples, rate, target_rate=TARGET_SAMPLE_RATE, taps=63):
+    '''
+    Resamples mono `samples` to `target_rate`, low-pass filtering first when downsampling to avoid aliasing
+    '''
+    if rate == target_rate or len(samples) == 0:
+        return samples
+    if target_rate < rate:
+        # Windowed-sinc low-pass at the new Nyquist frequency
+        cutoff = target_rate / rate / 2
+        n = np.arange(taps) - (taps - 1) / 2
+        kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+        samples = np.convolve(samples, (kernel / kernel.sum()).astype(np.float32), mode="same")
+    duration = len(samples) / rate
+    positions = np.arange(int(duration * target_rate)) * (rate / target_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+def preprocess_for_stt(data):
+    """
+    Prepare a recording for speech-to-text: downmix to mono, trim leading and trailing
+    silence, and resample to 16 kHz 16-bit PCM.
+
+    Args:
+        data (bytes | memoryview): The recording as a WAV file.
+
+    Returns:
+        bytes: The processed WAV file, or the original data if it is not a PCM WAV file.
+    """
+    started = time.perf_counter()
+    try:
+        samples, rate = decode_wav(bytes(data))
+    except (wave.Error, EOFError, ValueError) as e:
+        logger.warning(f"Uploading the recording unprocessed, it is not a PCM WAV file: {e!r}")
+        return data
+
+    mono = samples.mean(axis=1)
+    processed = encode_wav(resample(trim_silence(mono, rate), rate), TARGET_SAMPLE_RATE)
+    if len(processed) >= len(data):
+        return data
+
+    logger.info(
+        f"Preprocessed recording for STT: {len(data)} -> {len(processed)} bytes "
+        f"({len(data) - len(processed)} saved) in {(time.perf_counter() - started) * 1000:.1f} ms."
+    )
+    return processed
@@ -0,0 +1,105 @@
+import logging
+
+import numpy as np
+from langchain_core.documents import Document
+
+from src.embedding_pipeline import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Tokens of retrieved context stuffed into the prompt
+CONTEXT_TOKEN_BUDGET = 1200
+# Trade-off between relevance (1.0) and diversity (0.0) when selecting chunks
+MMR_LAMBDA = 0.7
+# Tokens the "stuff" chain adds between two documents
+DOCUMENT_SEPARATOR_TOKENS = 2
+
+
+def mmr_order(query_vector, vectors, lambda_mult=MMR_LAMBDA):
+    '''
+    Returns the positions of `vectors` in maximal marginal relevance order: each step picks the
+    candidate most similar to the query and least similar to the candidates picked before it
+    '''
+    if len(vectors) == 0:
+        return []
+    relevance = vectors @ query_vector
+    similarity = vectors @ vectors.T
+    order = [int(np.argmax(relevance))]
+    redundancy = similarity[order[0]].copy()
+    remaining = np.ones(len(vectors), dtype=bool)
+    remaining[order[0]] = False
+    while remaining.any():
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[~remaining] = -np.inf
+        best = int(np.argmax(scores))
+        order.append(best)
+        remaining[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return order
+
+
+def merge_overlapping(chunks):
+    '''
+    Merges chunks of the same page whose spans overlap or touch into one chunk, so overlapping text is sent once.
+
+    Chunks are dicts with "doc_id", "source", "page", "start", "text" and "score", and are
+    returned in order of their best score. Chunks with an unknown offset (-1) are kept as they are.
+    '''
+    merged = []
+    for chunk in sorted(chunks, key=lambda c: (c["doc_id"], c.get("page") or 0, c["start"])):
+        previous = merged[-1] if merged else None
+        if (previous is not None and chunk["start"] >= 0 and previous["start"] >= 0
+                and previous["doc_id"] == chunk["doc_id"] and previous.get("page") == chunk.get("page")
+                and chunk["start"] <= previous["start"] + len(previous["text"])):
+            end = previous["start"] + len(previous["text"])
+            previous["text"] += chunk["text"][end - chunk["start"]:]
+            previous["score"] = max(previous["score"], chunk["score"])
+        else:
+            merged.append(dict(chunk))
+    merged.sort(key=lambda c: c["score"], reverse=True)
+    return merged
+
+
+def pack_context(candidates, query_vector, token_budget=CONTEXT_TOKEN_BUDGET, lambda_mult=MMR_LAMBDA):
+    """
+    Selects retrieved chunks for the prompt until `token_budget` is used up.
+
+    Candidates are taken in MMR order, and overlapping chunks of the same page are
+    merged before their tokens are counted, so the budget is spent on distinct text.
+
+    Args:
+        candidates (list[tuple[float, IndexSegment, int]]): Retrieved (score, segment, chunk position) triples.
+        query_vector (np.ndarray): L2-normalised query embedding, or None to keep the candidates' order.
+        token_budget (int): Maximum number of context tokens.
+        lambda_mult (float): MMR relevance/diversity trade-off.
+
+    Returns:
+        list[Document]: The packed context, most relevant first.
+    """
+    if not candidates:
+        return []
+    vectors = np.stack([np.asarray(segment.vectors[i]) for _, segment, i in candidates])
+
+    selected = []
+    order = range(len(candidates)) if query_vector is None else mmr_order(query_vector, vectors, lambda_mult)
+    for position in order:
+        score, segment, i = candidates[position]
+        chunk = segment.chunks[i]
+        trial = merge_overlapping(selected + [{
+            "doc_id": segment.doc_id, "source": segment.source, "page": chunk.get("page"),
+            "start": chunk["start"], "text": chunk["text"], "score": float(score),
+        }])
+        tokens = sum(count_tokens(c["text"]) + DOCUMENT_SEPARATOR_TOKENS for c in trial)
+        if tokens > token_budget:
+            # A smaller or overlapping chunk further down may still fit
+            continue
+        selected = trial
+
+    logger.info(f"Packed {len(selected)} context passage(s) from {len(candidates)} candidates.")
+    documents = []
+    for c in selected:
+        metadata = {"source": c["source"], "doc_id": c["doc_id"], "start_index": c["start"], "score": c["score"]}
+        if c["page"] is not None:
+            metadata["page"] = c["page"]
+        documents.append(Document(page_content=c["text"], metadata=metadata))
+    return documents
@@ -0,0 +1,204 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Default location and size of the on-disk embedding cache
+EMBEDDING_CACHE_PATH = os.path.join("embedding_cache", "embeddings.sqlite3")
+EMBEDDING_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def embedding_key(text, deployment):
+    '''
+    Returns the content hash used to address the embedding of `text` produced by `deployment`
+    '''
+    digest = hashlib.sha256()
+    digest.update(deployment.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed store of embedding vectors.
+
+    Vectors are stored as float32 blobs in a SQLite database keyed by
+    `embedding_key(text, deployment)`. When the stored vectors exceed
+    `max_bytes`, the least recently used entries are evicted.
+
+    Args:
+        path (str): Location of the SQLite database file.
+        max_bytes (int): Upper bound on the total size of the stored vectors.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # One connection shared by all Streamlit script threads, serialised by the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                nbytes INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    def get_many(self, keys):
+        """
+        Looks up the vectors stored under `keys`.
+
+        Args:
+            keys (list[str]): Cache keys to look up.
+
+        Returns:
+            dict: Mapping of the keys that were found to their vectors (lists of floats).
+        """
+        found = {}
+        if not keys:
+            return found
+
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found]
+                )
+                self._conn.commit()
+
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+
+        return found
+
+    def put_many(self, items):
+        """
+        Stores vectors and evicts the least recently used entries if the cache is over budget.
+
+        Args:
+            items (dict): Mapping of cache keys to vectors.
+        """
+        if not items:
+            return
+
+        now = time.time()
+        rows = []
+        for key, vector in items.items():
+            blob = np.asarray(vector, dtype=np.float32).tobytes()
+            rows.append((key, blob, len(blob), now))
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, nbytes, last_used) VALUES (?, ?, ?, ?)", rows
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # Caller must hold the lock
+        total = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        evicted = 0
+        cursor = self._conn.execute("SELECT key, nbytes FROM embeddings ORDER BY last_used ASC")
+        stale_keys = []
+        for key, nbytes in cursor:
+            if total <= self.max_bytes:
+                break
+            stale_keys.append((key,))
+            total -= nbytes
+            evicted += 1
+        self._conn.executemany("DELETE FROM embeddings WHERE key = ?", stale_keys)
+        logger.info(f"Embedding cache evicted {evicted} entries to stay under {self.max_bytes} bytes.")
+
+    def stats(self):
+        """
+        Returns:
+            dict: Hit/miss counters and the current size of the cache.
+        """
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM embeddings"
+            ).fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "bytes": total,
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that serves document vectors from an `EmbeddingCache`
+    and only sends cache misses to the underlying embeddings model.
+
+    Args:
+        underlying (Embeddings): The embeddings model used for cache misses.
+        cache (EmbeddingCache): The persistent vector cache.
+        deployment (str): Name of the embedding deployment, part of the cache key.
+    """
+
+    def __init__(self, underlying, cache, deployment):
+        self.underlying = underlying
+        self.cache = cache
+        self.deployment = deployment
+
+    def embed_documents(self, texts):
+        keys = [embedding_key(text, self.deployment) for text in texts]
+        cached = self.cache.get_many(keys)
+
+        # Embed each distinct missing text once, preserving input order
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        if missing:
+            vectors = self.underlying.embed_documents(list(missing.values()))
+            new_items = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(new_items)
+            cached.update(new_items)
+
+        logger.info(f"Embedded {len(texts)} chunks ({len(missing)} distinct chunks sent to the API).")
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        return self.underlying.embed_query(text)
@@ -0,0 +1,185 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
+
+import openai
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Azure OpenAI accepts at most 16 inputs per embeddings request for text-embedding-ada-002
+EMBEDDING_BATCH_SIZE = 16
+EMBEDDING_MAX_WORKERS = 4
+EMBEDDING_TOKENS_PER_MINUTE = 120_000
+EMBEDDING_MAX_RETRIES = 6
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    # Loaded once: without a cached encoding file tiktoken downloads it, which fails on offline hosts
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        logger.warning("tiktoken encoding unavailable, estimating token counts from text length.")
+        return None
+
+
+def count_tokens(text):
+    '''
+    Returns the number of cl100k_base tokens in `text`, falling back to a rough estimate if tiktoken is unavailable
+    '''
+    encoding = _encoding()
+    if encoding is None:
+        return max(1, len(text) // 4)
+    return len(encoding.encode(text))
+
+
+class TokenRateLimiter:
+    """
+    Token bucket that keeps the embedding requests of the whole process under a tokens-per-minute quota.
+
+    Args:
+        tokens_per_minute (int): The Azure deployment's TPM limit.
+    """
+
+    def __init__(self, tokens_per_minute=EMBEDDING_TOKENS_PER_MINUTE):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60.0
+        self.available = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens):
+        """
+        Blocks until `tokens` can be spent without exceeding the quota.
+        """
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= tokens:
+                    self.available -= tokens
+                    return
+                wait = (tokens - self.available) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Drains the bucket so that every worker backs off for `seconds`, e.g. after a 429 response.
+        """
+        with self._lock:
+            self.available = min(self.available, -seconds * self.rate)
+
+
+def _retry_after(error):
+    '''
+    Returns the number of seconds requested by a 429 response, or None if `error` is not a rate limit error
+    '''
+    if not (isinstance(error, openai.error.RateLimitError) or getattr(error, "http_status", None) == 429):
+        return None
+    headers = getattr(error, "headers", None) or {}
+    for header in ("retry-after-ms", "Retry-After-Ms", "x-ms-retry-after-ms"):
+        if header in headers:
+            try:
+                return float(headers[header]) / 1000
+            except ValueError:
+                pass
+    for header in ("Retry-After", "retry-after"):
+        if header in headers:
+            try:
+                return float(headers[header])
+            except ValueError:
+                pass
+    return 0.0
+
+
+class BatchedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that splits documents into batches and embeds them on a bounded thread pool.
+
+    Rate limited requests are retried after the server's Retry-After delay (or with
+    exponential backoff), and a shared `TokenRateLimiter` keeps the process under
+    the deployment's tokens-per-minute quota.
+
+    Args:
+        underlying (Embeddings): The embeddings model that sends the API requests.
+        batch_size (int): Number of texts per request.
+        max_workers (int): Maximum number of requests in flight.
+        rate_limiter (TokenRateLimiter): Limiter shared by all callers.
+        max_retries (int): Attempts per batch before giving up.
+    """
+
+    def __init__(self, underlying, batch_size=EMBEDDING_BATCH_SIZE, max_workers=EMBEDDING_MAX_WORKERS,
+                 rate_limiter=None, max_retries=EMBEDDING_MAX_RETRIES):
+        self.underlying = underlying
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.rate_limiter = rate_limiter or TokenRateLimiter()
+        self.max_retries = max_retries
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="embedding")
+        self._local = threading.local()
+
+    @contextmanager
+    def report_progress(self, callback):
+        """
+        Calls `callback(done, total)` from the calling thread as batches finish.
+
+        The callback is scoped to the current thread so that sessions sharing
+        this object only see their own progress.
+        """
+        previous = getattr(self._local, "callback", None)
+        self._local.callback = callback
+        try:
+            yield
+        finally:
+            self._local.callback = previous
+
+    def _embed_batch(self, batch):
+        self.rate_limiter.acquire(sum(count_tokens(text) for text in batch))
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                return self.underlying.embed_documents(batch)
+            except Exception as e:
+                retry_after = _retry_after(e)
+                if retry_after is None or attempt == self.max_retries:
+                    raise
+                # Honour Retry-After when given, otherwise back off exponentially with jitter
+                delay = retry_after or min(60, 2 ** attempt) + random.uniform(0, 1)
+                logger.warning(f"Embedding request rate limited, retrying in {delay:.1f}s (attempt {attempt}).")
+                self.rate_limiter.pause(delay)
+                time.sleep(delay)
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+
+        batches = [texts[start:start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+        callback = getattr(self._local, "callback", None)
+        results = [None] * len(batches)
+        futures = {self._executor.submit(self._embed_batch, batch): i for i, batch in enumerate(batches)}
+
+        done = 0
+        try:
+            for future in as_completed(futures):
+                i = futures[future]
+                results[i] = future.result()
+                done += len(batches[i])
+                if callback:
+                    callback(done, len(texts))
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+        logger.info(f"Embedded {len(texts)} texts in {len(batches)} batches.")
+        return [vector for batch_vectors in results for vector in batch_vectors]
+
+    def embed_query(self, text):
+        return self.underlying.embed_query(text)
@@ -0,0 +1,133 @@
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Default size of the extraction cache
+EXTRACTION_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+class ExtractionCache:
+    """
+    On-disk cache of extracted document text, addressed by the hash of the uploaded file.
+
+    Entries are written to a private temporary file and atomically renamed to
+    `<cache_dir>/<digest>.txt`, so sessions extracting the same or same-named
+    files never overwrite each other's output. Entries are touched on every hit
+    and the least recently used ones are removed once the cache exceeds `max_bytes`.
+
+    Args:
+        cache_dir (str): Directory holding the cache entries.
+        max_bytes (int): Upper bound on the total size of the entries.
+    """
+
+    def __init__(self, cache_dir, max_bytes=EXTRACTION_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.cache_dir, f"{digest}.txt")
+
+    def get(self, digest):
+        """
+        Returns:
+            str: Path of the cached extraction for `digest`, or None on a miss.
+        """
+        path = self.path(digest)
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def read(self, digest):
+        """
+        Returns:
+            str: The cached extraction for `digest`, or None on a miss.
+        """
+        path = self.get(digest)
+        if path is None:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            # Evicted between the lookup and the read
+            return None
+
+    def put(self, digest, content):
+        """
+        Stores the extracted text of the file identified by `digest`.
+
+        Returns:
+            str: Path of the cache entry.
+        """
+        path = self.path(digest)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._evict(keep=path)
+        return path
+
+    def _evict(self, keep=None):
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.cache_dir):
+                if not entry.name.endswith(".txt"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+            if total <= self.max_bytes:
+                return
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                    logger.info(f"Evicted extraction cache entry: {path}")
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_extraction_cache(cache_dir):
+    '''
+    Returns the process-wide ExtractionCache for `cache_dir`, so hit/miss counters are shared by all sessions
+    '''
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = ExtractionCache(cache_dir)
+        return _caches[cache_dir]
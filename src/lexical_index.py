@@ -0,0 +1,111 @@
+import logging
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+from src.ann import top_k
+
+logger = logging.getLogger(__name__)
+
+# Words, numbers and compound identifiers such as "XR-200", "v2.3.1" or "ISO/IEC"
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./:]\w+)*")
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text):
+    '''
+    Returns the lower-cased terms of `text`; compound tokens are indexed whole and by their parts
+    '''
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        terms.append(token)
+        parts = re.split(r"[-./:]", token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part)
+    return terms
+
+
+def identifier_term(query):
+    '''
+    Returns the term to look up if `query` is a bare identifier, part number or acronym, otherwise None
+    '''
+    query = query.strip().strip("\"'`?")
+    if not TOKEN_PATTERN.fullmatch(query):
+        return None
+    if any(ch.isdigit() for ch in query) or (len(query) >= 2 and query.isupper()):
+        return query.lower()
+    return None
+
+
+class BM25Index:
+    """
+    BM25 inverted index over the chunks of one document.
+
+    Postings are stored as flat arrays sorted by term (CSR layout): `offsets[t]:offsets[t + 1]`
+    slices the chunk ids and term frequencies of term `t` out of `doc_ids` and `term_freqs`.
+    """
+
+    def __init__(self, terms, offsets, doc_ids, term_freqs, doc_lengths):
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.average_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+    @classmethod
+    def build(cls, texts):
+        counts = [Counter(tokenize(text)) for text in texts]
+        terms = sorted(set().union(*counts))
+        term_ids = {term: i for i, term in enumerate(terms)}
+
+        postings = [[] for _ in terms]
+        for doc_id, doc_counts in enumerate(counts):
+            for term, freq in doc_counts.items():
+                postings[term_ids[term]].append((doc_id, freq))
+
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in postings], out=offsets[1:])
+        flat = [posting for term_postings in postings for posting in term_postings]
+        doc_ids = np.array([doc_id for doc_id, _ in flat], dtype=np.int32)
+        term_freqs = np.array([freq for _, freq in flat], dtype=np.float32)
+        doc_lengths = np.array([sum(doc_counts.values()) for doc_counts in counts], dtype=np.float32)
+        return cls(terms, offsets, doc_ids, term_freqs, doc_lengths)
+
+    def save(self, path):
+        terms = np.array(sorted(self.vocabulary, key=self.vocabulary.get), dtype=str)
+        np.savez(path, terms=terms, offsets=self.offsets, doc_ids=self.doc_ids,
+                 term_freqs=self.term_freqs, doc_lengths=self.doc_lengths)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["terms"].tolist(), data["offsets"], data["doc_ids"], data["term_freqs"], data["doc_lengths"])
+
+    def search(self, terms, k):
+        """
+        Returns:
+            list[tuple[float, int]]: The `k` best (BM25 score, chunk position) pairs, best first.
+        """
+        n = len(self.doc_lengths)
+        if n == 0:
+            return []
+        scores = np.zeros(n, dtype=np.float32)
+        for term in set(terms):
+            t = self.vocabulary.get(term)
+            if t is None:
+                continue
+            start, end = self.offsets[t], self.offsets[t + 1]
+            ids, freqs = self.doc_ids[start:end], self.term_freqs[start:end]
+            idf = math.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[ids] / self.average_length)
+            # Each chunk appears once per term, so a fancy-indexed add is safe
+            scores[ids] += idf * freqs * (BM25_K1 + 1) / (freqs + norm)
+        hits = np.flatnonzero(scores)
+        return [(float(scores[i]), int(i)) for i in hits[top_k(scores[hits], k)]]
+
+    def nbytes(self):
+        return self.offsets.nbytes + self.doc_ids.nbytes + self.term_freqs.nbytes + self.doc_lengths.nbytes
@@ -0,0 +1,240 @@
+import logging
+import os
+import weakref
+
+import openai
+from langchain import PromptTemplate
+from langchain.chains import RetrievalQA
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings import OpenAIEmbeddings
+
+from src.answer_cache import SemanticAnswerCache, document_set_hash
+from src.embedding_cache import CachedEmbeddings, EmbeddingCache
+from src.embedding_pipeline import BatchedEmbeddings, TokenRateLimiter
+from src.lexical_index import identifier_term
+from src.rag_functions import (IncompletePages, LLMTelemetryHandler, RollingSummaryMemory, chunk_pages,
+                               extract_contents_from_doc)
+from src.segment_registry import SegmentRegistry
+from src.telemetry import telemetry
+from src.vector_index import IndexSegment, VectorIndex
+
+logger = logging.getLogger(__name__)
+
+# Prompt Template
+QA_PROMPT = PromptTemplate(
+    input_variables=["history", "context", "question"],
+    template="""
+Use the following context (delimited by <ctx></ctx>) and the chat history (delimited by <hs></hs>) to answer the user's question. 
+If you don't know the answer, just say that you don't know, don't try to make up an answer.
+------
+<ctx>
+{context}
+</ctx>
+------
+<hs>
+{history}
+</hs>
+------
+{question}
+Answer:
+""",
+)
+
+
+def create_llm():
+    '''
+    Returns the Azure OpenAI chat model that answers questions, streaming its tokens to the callbacks
+    '''
+    # Configure OpenAI API using Azure OpenAI
+    openai.api_key = os.getenv("API_KEY")
+    openai.api_base = os.getenv("ENDPOINT")
+    openai.api_type = "azure"
+    openai.api_version = os.getenv("OPENAI_API_VERSION")
+
+    return ChatOpenAI(
+        temperature=0.3, openai_api_key=os.getenv("API_KEY"),
+        openai_api_base=os.getenv("ENDPOINT"), model_name="gpt-35-turbo", engine="Voicetask",
+        streaming=True
+    )
+
+
+def create_embeddings():
+    '''
+    Returns the embeddings model, meant to be shared by all sessions so cached vectors and the TPM budget are shared too
+    '''
+    deployment = "text-embedding-ada-002"
+    batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", 16))
+    openai_embeddings = OpenAIEmbeddings(
+        openai_api_version=os.getenv("OPENAI_API_VERSION"),
+        openai_api_key=os.getenv("API_KEY"),
+        openai_api_base=os.getenv("ENDPOINT"),
+        openai_api_type="azure",
+        deployment=deployment,
+        chunk_size=batch_size,
+        max_retries=1  # rate limits are retried by BatchedEmbeddings using Retry-After
+    )
+    batched_embeddings = BatchedEmbeddings(
+        openai_embeddings,
+        batch_size=batch_size,
+        max_workers=int(os.getenv("EMBEDDING_MAX_WORKERS", 4)),
+        rate_limiter=TokenRateLimiter(int(os.getenv("EMBEDDING_TOKENS_PER_MINUTE", 120000)))
+    )
+    logger.info("OpenAI Embeddings initialized successfully.")
+    return CachedEmbeddings(batched_embeddings, EmbeddingCache(), deployment)
+
+
+def create_answer_cache():
+    return SemanticAnswerCache(
+        threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.97)),
+        ttl=float(os.getenv("ANSWER_CACHE_TTL", 24 * 60 * 60))
+    )
+
+
+def create_segment_registry():
+    return SegmentRegistry(max_bytes=int(os.getenv("SEGMENT_REGISTRY_MB", 1024)) * 1024 * 1024)
+
+
+def update_vector_store(files, session_id, vector_store, embeddings, registry, temp_dir="temp_dir", progress=None):
+    """
+    Brings the vector store in line with the uploaded documents: documents that are no
+    longer uploaded are removed, and only new documents are taken from the shared
+    segment registry, loaded from the on-disk index or run through
+    extract -> chunk -> embed, entirely in memory.
+
+    The index is only changed once every new document is ready, so if loading or
+    embedding raises, `vector_store` still holds the documents it had before.
+
+    Args:
+        files (list[ProbedFile]): The validated documents of the session.
+        session_id (str): ID of the session, used to reference count the shared segments.
+        vector_store (VectorIndex): The session's current index, a new one is created if None.
+        embeddings (CachedEmbeddings): Shared embeddings model, see `create_embeddings`.
+        registry (SegmentRegistry): Shared segment registry.
+        temp_dir (str): Directory of the extraction cache.
+        progress (callable): Called with (file, chunks embedded, total chunks) while a document is embedded.
+
+    Returns:
+        VectorIndex: The session's index over the uploaded documents.
+    """
+    if vector_store is None:
+        vector_store = VectorIndex([], embeddings)
+        # Sessions have no reliable end-of-session hook, release their segments when the index is collected
+        weakref.finalize(vector_store, registry.release_session, session_id)
+
+    uploaded_ids = {file.digest for file in files}
+    new_segments = {}
+    acquired = []
+    try:
+        missing_files = []
+        seen = set()
+        for file in files:
+            if file.digest in vector_store or file.digest in seen:
+                continue
+            seen.add(file.digest)
+            segment = registry.acquire(session_id, file.digest, lambda: IndexSegment.load(file.digest))
+            if segment is not None:
+                acquired.append(file.digest)
+                new_segments[file.digest] = segment
+            else:
+                missing_files.append(file)
+
+        #extracting new documents concurrently, each one is chunked and embedded as soon as its pages are ready
+        for pages, file in zip(extract_contents_from_doc(missing_files, temp_dir), missing_files):
+            if pages is None:
+                continue
+            with telemetry.span("chunking", source=file.name, pages=len(pages)) as span:
+                chunks = list(chunk_pages(pages))
+                span["chunks"] = len(chunks)
+            logger.info(f"Document {file.name} chunked into {len(chunks)} chunks.")
+
+            # pages that needed OCR which could not run are indexed for this session only, so they are OCR'd later
+            persist = not isinstance(pages, IncompletePages)
+            if progress is None:
+                segment = IndexSegment.build(file.digest, file.name, chunks, embeddings, persist=persist)
+            else:
+                progress(file, 0, len(chunks))
+                with embeddings.underlying.report_progress(lambda done, total: progress(file, done, total)):
+                    segment = IndexSegment.build(file.digest, file.name, chunks, embeddings, persist=persist)
+            if persist:
+                segment = registry.acquire(session_id, file.digest, lambda: segment)
+                acquired.append(file.digest)
+            new_segments[file.digest] = segment
+    except Exception:
+        # the session keeps its current documents, the segments taken for this upload are given back
+        for doc_id in acquired:
+            registry.release(session_id, doc_id)
+        raise
+
+    for doc_id in vector_store.doc_ids:
+        if doc_id not in uploaded_ids:
+            vector_store.remove(doc_id)
+            registry.release(session_id, doc_id)
+    for segment in new_segments.values():
+        vector_store.add(segment)
+
+    logger.info(f"VectorIndex vector store updated, {len(vector_store.doc_ids)} document(s) indexed.")
+    logger.info(f"Embedding cache stats: {embeddings.cache.stats()}")
+    logger.info(f"Segment registry stats: {registry.stats()}, loaded segments: {registry.memory_report()}")
+    return vector_store
+
+
+def build_qa_chain(vector_store, llm, conversation):
+    '''
+    Returns a RetrievalQA chain over `vector_store` whose chat history is the rolling summary of `conversation`
+    '''
+    # fuse dense and BM25 retrieval, then pack diverse, de-duplicated chunks into a token budget
+    retriever = vector_store.as_retriever(search_kwargs={
+        'token_budget': int(os.getenv("CONTEXT_TOKEN_BUDGET", 1200)),
+        'fetch_k': 12,
+        'hybrid': True
+    })
+    return RetrievalQA.from_chain_type(
+        llm = llm,
+        chain_type = "stuff",
+        retriever = retriever,
+        verbose = False,
+        chain_type_kwargs = {
+            "verbose": True,
+            "prompt": QA_PROMPT,
+            "memory": RollingSummaryMemory(conversation = conversation)
+                    }
+        )
+
+
+def answer_question(question, qa_chain, conversation, answer_cache, callbacks=None):
+    """
+    Answers one turn of a conversation about the documents indexed by `qa_chain`.
+
+    The rolling summary is the chat history of the prompt, and near-identical questions
+    about the same documents reuse the stored answer instead of calling the LLM. The
+    answer cache is shared by all sessions, so it is only used for the first turn of a
+    conversation, whose answer does not depend on the chat history in the prompt.
+
+    Args:
+        question (str): The user's question.
+        qa_chain (RetrievalQA): The session's chain, see `build_qa_chain`.
+        conversation (RollingSummary): The session's conversation summary, the one `qa_chain` was built with.
+        answer_cache (SemanticAnswerCache): Shared answer cache.
+        callbacks (list): LangChain callback handlers receiving the streamed answer tokens.
+
+    Returns:
+        tuple: (str, bool) - The answer and True if it was served from the answer cache.
+    """
+    # answers that depend on the session's history must not be shared with other sessions
+    cacheable = not conversation.history()
+
+    vector_store = qa_chain.retriever.index
+    doc_set = document_set_hash(vector_store.doc_ids)
+    # bare identifiers are answered from the inverted index, so they are not embedded for the cache either
+    query_vector = vector_store.embed_query(question) if cacheable and identifier_term(question) is None else None
+    response = answer_cache.get(doc_set, query_vector) if query_vector is not None else None
+    cached = response is not None
+    if not cached:
+        response = qa_chain.run(question, callbacks=[*(callbacks or []), LLMTelemetryHandler()])
+        if query_vector is not None:
+            answer_cache.put(doc_set, question, query_vector, response)
+    logger.info(f"Answer cache stats: {answer_cache.stats()}")
+
+    # fold the turn into the summary in the background, off the critical path
+    conversation.add_turn(question, response)
+    return response, cached
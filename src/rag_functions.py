@@ -1,13 +1,25 @@
 from io import BytesIO
-from PyPDF2 import PdfReader
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from PyPDF2 import PdfReader, PdfWriter
 from pptx import Presentation
+import json
 import logging
 import os
+import string
+import threading
+import time
+import contextvars
+from typing import Any
 from dotenv import load_dotenv
-from werkzeug.utils import secure_filename
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.memory import BaseMemory
+from src.extraction_cache import get_extraction_cache
+from src.telemetry import telemetry
+from src.vector_index import document_hash, locate_chunks
 
 import os
 
@@ -54,31 +66,72 @@ def allowed_files(filename):
     '''
     return "." in filename and filename.rsplit(".", 1)[1].lower() in allowed_files_list
 
+def encode_pages(pages):
+    '''
+    Returns the pages of a document as a JSON list for the extraction cache, which keeps any text in the pages intact
+    '''
+    return json.dumps(list(pages), ensure_ascii=False)
+
+def decode_pages(content):
+    '''
+    Returns the pages stored by `encode_pages`, or None if `content` is not a list of pages (e.g. an older cache entry)
+    '''
+    try:
+        pages = json.loads(content)
+    except ValueError:
+        return None
+    if not isinstance(pages, list) or not all(isinstance(page, str) for page in pages):
+        return None
+    return pages
+
+# PDF pages whose text layer scores below this, or has fewer characters, are sent to OCR
+TEXT_LAYER_MIN_QUALITY = 0.8
+TEXT_LAYER_MIN_CHARS = 20
+
+@dataclass
+class ProbedFile:
+    """
+    An uploaded file read and parsed once, shared by validation and extraction.
+
+    `parsed` holds the PdfReader (PDF), Presentation (PPTX) or decoded text (TXT).
+    """
+    name: str
+    ext: str
+    data: bytes
+    digest: str
+    num_pages: int
+    parsed: object = None
+
+def probe_file(uploaded_file):
+    '''
+    Reads and parses an uploaded file once, counting its pages (for PDFs), slides (for PPTX), or lines (for TXT)
+
+    Raises:
+        ValueError: If the file type is not supported.
+    '''
+    file_ext = uploaded_file.name.rsplit(".", 1)[1].lower()  # Extract the file extension
+    data = uploaded_file.getvalue() if hasattr(uploaded_file, "getvalue") else uploaded_file.read()
+
+    if file_ext == "pdf":
+        parsed = PdfReader(BytesIO(data))
+        num_pages = len(parsed.pages)
+    elif file_ext == "pptx":
+        parsed = Presentation(BytesIO(data))
+        num_pages = len(parsed.slides)
+    elif file_ext == "txt":
+        parsed = data.decode("utf-8")
+        num_pages = len(parsed.splitlines())
+    else:
+        raise ValueError(f"Unsupported file extension: {file_ext}")
+
+    return ProbedFile(uploaded_file.name, file_ext, data, document_hash(data), num_pages, parsed)
+
 def file_check_num(uploaded_file):
     '''
     Returns the number of pages (for PDFs), slides (for PPTX), or lines (for TXT) in the file
     '''
-    file_ext = uploaded_file.name.rsplit(".", 1)[1].lower()  # Extract the file extension
     try:
-        if file_ext == "pdf":
-            pdf_bytes = BytesIO(uploaded_file.read())
-            pdf_reader = PdfReader(pdf_bytes)
-            uploaded_file.seek(0)  # Reset file pointer after reading
-            return len(pdf_reader.pages)
-        
-        elif file_ext == "pptx":
-            pptx_bytes = BytesIO(uploaded_file.read())
-            pptx = Presentation(pptx_bytes)
-            uploaded_file.seek(0)
-            return len(pptx.slides)
-        
-        elif file_ext == "txt":
-            num = len(uploaded_file.read().decode("utf-8").splitlines())
-            uploaded_file.seek(0)
-            return num
-        else:
-            logger.error(f"Unsupported file extension: {file_ext}")
-            return -1
+        return probe_file(uploaded_file).num_pages
     except Exception as e:
         logger.error(f"Error checking file '{uploaded_file.name}': {e}")
         return -1
@@ -95,89 +148,281 @@ def chunk_document(text, chunk_size=1000, chunk_overlap=300):
     chunks = text_splitter.split_text(text)
     return chunks
 
-def extract_contents_from_doc(files, temp_dir):
+def chunk_pages(pages, chunk_size=1000, chunk_overlap=300):
+    '''
+    Yields the chunks of a document page by page, as dicts with the chunk text, its page number and its offset in the page
+    '''
+    for page_number, page_text in enumerate(pages, start=1):
+        chunks = chunk_document(page_text, chunk_size, chunk_overlap)
+        for chunk, offset in zip(chunks, locate_chunks(page_text, chunks)):
+            yield {"text": chunk, "page": page_number, "start": offset}
+
+def read_pdf_result(result):
+    '''
+    Returns the text of each page of an Azure Document Intelligence "prebuilt-read" result
+    '''
+    return ["\n".join(line.content for line in page.lines) for page in result.pages]
+
+def text_layer_quality(text):
+    '''
+    Scores the embedded text layer of a PDF page between 0 (missing or garbled) and 1 (clean, readable text)
+    '''
+    stripped = text.strip()
+    if len(stripped) < TEXT_LAYER_MIN_CHARS:
+        # Scanned page without a text layer
+        return 0.0
+
+    readable = sum(1 for ch in stripped if ch.isalnum() or ch.isspace() or ch in string.punctuation)
+    score = readable / len(stripped)
+
+    # Text extracted without spacing collapses into implausibly long "words"
+    words = stripped.split()
+    if sum(len(word) for word in words) / len(words) > 25:
+        score *= 0.5
+    return score
+
+def extract_text_layer(file):
+    '''
+    Returns the embedded text of each page of a probed PDF, using an empty string for pages that cannot be read
+    '''
+    pages = []
+    for page in file.parsed.pages:
+        try:
+            pages.append(page.extract_text() or "")
+        except Exception as e:
+            logger.warning(f"Could not read the text layer of a page in {file.name}: {e}")
+            pages.append("")
+    return pages
+
+def pdf_subset(reader, page_indices):
+    '''
+    Returns the bytes of a new PDF made of the given pages of `reader`
+    '''
+    writer = PdfWriter()
+    for i in page_indices:
+        writer.add_page(reader.pages[i])
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+class IncompletePages(list):
+    """
+    Page texts of a PDF whose scanned or garbled pages could not be sent to OCR.
+
+    They are usable for the current session but are not cached or indexed on disk, so
+    the document is extracted again once Document Intelligence is configured.
+    """
+
+def start_pdf_ocr(file, text_pages, client):
+    '''
+    Sends the pages of a PDF whose text layer is missing or garbled to Azure Document Intelligence
+
+    Returns:
+        A function that waits for the OCR results and returns the text of every page, as
+        `IncompletePages` if pages needed OCR but no client is configured.
+    '''
+    ocr_pages = [i for i, text in enumerate(text_pages) if text_layer_quality(text) < TEXT_LAYER_MIN_QUALITY]
+    logger.info(f"Processing PDF file: {file.name} ({len(text_pages) - len(ocr_pages)} page(s) from the text layer, "
+                f"{len(ocr_pages)} sent to OCR)")
+    if not ocr_pages:
+        return lambda: text_pages
+    if client is None:
+        logger.warning("Azure Document Intelligence credentials are missing, using the text layer of every page.")
+        return lambda: IncompletePages(text_pages)
+
+    # Only upload the pages that need OCR
+    data = file.data if len(ocr_pages) == len(text_pages) else pdf_subset(file.parsed, ocr_pages)
+    poller = client.begin_analyze_document("prebuilt-read", data)
+
+    def merge_pages():
+        pages = list(text_pages)
+        for i, text in zip(ocr_pages, read_pdf_result(poller.result())):
+            pages[i] = text
+        return pages
+    return merge_pages
+
+def extract_local_pages(file):
+    '''
+    Returns the text of each page of a probed TXT file (a single page) or PPTX file (one page per slide)
+    '''
+    if file.ext == "txt":
+        logger.info(f"Processing TXT file: {file.name}")
+        return [file.parsed]
+
+    # Extract content from .pptx using python-pptx
+    logger.info(f"Processing PPTX file: {file.name}")
+    return [
+        "\n".join(shape.text for shape in slide.shapes if hasattr(shape, "text"))
+        for slide in file.parsed.slides
+    ]
+
+def extract_contents_from_doc(files, temp_dir, max_workers=4):
     """
     Azure Document Intelligence
+
+    PDF pages with a good embedded text layer are read locally; only scanned or
+    garbled pages are sent to Document Intelligence. The OCR of every PDF is started
+    before waiting on any of them, and TXT/PPTX files are parsed on a worker pool
+    while OCR is in flight, so the total time is close to that of the slowest file.
+    Extractions are cached in `temp_dir` under the hash of the file contents, so
+    re-uploaded files skip extraction entirely. PDFs whose pages needed OCR that could
+    not run are yielded as `IncompletePages` and not cached.
+
+    This is a generator: each file's pages are yielded as soon as that file and all
+    the files before it are done, so callers can chunk and embed the first documents
+    while later ones are still being extracted.
+
     Args: 
-        files (uploaded by the user): List of uploaded files to process.
-        temp_dir (str): Directory path to store the extracted contents.
+        files (list[ProbedFile] or uploaded files): Files to process.
+        temp_dir (str): Directory path of the extraction cache.
+        max_workers (int): Number of threads parsing local files.
     
-    Returns: 
-        List of file paths where the extracted content is stored.
+    Yields: 
+        For each input file in order, the list of its page texts, or None if the
+        file could not be processed.
     """
     # Constants for Azure Document Intelligence
     DI_ENDPOINT = os.getenv("DOCUMENT_INTELLIGENCE_ENDPOINT")
     DOCUMENT_INTELLIGENCE_KEY = os.getenv('DOCUMENT_INTELLIGENCE_SUBSCRIPTION_KEY')
 
-    if not DI_ENDPOINT or not DOCUMENT_INTELLIGENCE_KEY:
-        logger.error("Azure Document Intelligence credentials are missing.")
-        return []
+    document_intelligence_client = None
+    if DI_ENDPOINT and DOCUMENT_INTELLIGENCE_KEY:
+        document_intelligence_client = DocumentAnalysisClient(
+            endpoint=DI_ENDPOINT,
+            credential=AzureKeyCredential(DOCUMENT_INTELLIGENCE_KEY)
+        )
 
-    document_intelligence_client = DocumentAnalysisClient(
-        endpoint=DI_ENDPOINT,
-        credential=AzureKeyCredential(DOCUMENT_INTELLIGENCE_KEY)
-    )
+    extraction_cache = get_extraction_cache(temp_dir)
 
-    # Ensure the temporary directory exists
-    os.makedirs(temp_dir, exist_ok=True)
-    logger.info(f"Temporary directory '{temp_dir}' is ready.")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Start every extraction: read PDF text layers and parse local files on the pool
+        pending = []
+        for file in files:
+            try:
+                if not isinstance(file, ProbedFile):
+                    file = probe_file(file)
 
-    extracted_file_paths = []
+                cached_content = extraction_cache.read(file.digest)
+                # Entries in an older format are extracted again and overwritten
+                pages = decode_pages(cached_content) if cached_content is not None else None
+                if pages is not None:
+                    logger.info(f"Using cached extraction of {file.name}")
+                    pending.append((file, lambda pages=pages: pages, False))
 
-    for file in files:
-        filename = secure_filename(file.name)
-        base, ext = os.path.splitext(filename)
-        ext = ext.lower()  # Normalize to lowercase for easier checking
-        
-        try:
-            if ext == '.pdf':
-                # Extract content using Azure Document Intelligence for PDF
-                file_content = file.read()
-                logger.info(f"Processing PDF file: {file.name}")
-                extract = document_intelligence_client.begin_analyze_document("prebuilt-read", file_content)
-                result = extract.result()
-                
-                # Extract text from each page
-                extracted_content = ""
-                for page in result.pages:
-                    for line in page.lines:
-                        extracted_content += line.content + "\n"
-                
-            elif ext == '.txt':
-                # Directly read .txt files
-                logger.info(f"Processing TXT file: {file.name}")
-                extracted_content = file.read().decode('utf-8')
-                
-            elif ext == '.pptx':
-                # Extract content from .pptx using python-pptx
-                logger.info(f"Processing PPTX file: {file.name}")
-                extracted_content = ""
-                presentation = Presentation(file)
-                for slide in presentation.slides:
-                    for shape in slide.shapes:
-                        if hasattr(shape, "text"):
-                            extracted_content += shape.text + "\n"
-            
-            else:
-                logger.warning(f"Unsupported file type: {file.name}")
-                continue  # Skip unsupported file types
-            
-            # Define path to save extracted content
-            extracted_filename = f"{base}_extracted.txt"  # Save as .txt for easier reading
-            file_path = os.path.join(temp_dir, extracted_filename)
-            
-            # Save the extracted content to a file
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(extracted_content)
-            
-            logger.info(f"Extracted content saved to: {file_path}")
-            extracted_file_paths.append(file_path)
+                elif file.ext == "pdf":
+                    text_layer = executor.submit(extract_text_layer, file)
+                    pending.append((file, text_layer, True))
 
-        except Exception as e:
-            logger.error(f"Error processing file '{file.name}': {e}")
-            continue  # Proceed with the next file in case of an error
+                else:
+                    future = executor.submit(extract_local_pages, file)
+                    pending.append((file, future.result, True))
 
-    return extracted_file_paths
+            except Exception as e:
+                logger.error(f"Error processing file '{getattr(file, 'name', file)}': {e}")
+                pending.append((file, None, False))  # Proceed with the next file in case of an error
+
+        # Send the PDF pages without a usable text layer to OCR, the analyses of all files run concurrently
+        # Time spent waiting on each file is recorded as its extraction span, work overlapped with other files is not
+        waited = [0.0] * len(pending)
+        for i, (file, text_layer, store) in enumerate(pending):
+            if not isinstance(text_layer, Future):
+                continue
+            started = time.perf_counter()
+            try:
+                get_pages = start_pdf_ocr(file, text_layer.result(), document_intelligence_client)
+                pending[i] = (file, get_pages, store)
+            except Exception as e:
+                logger.error(f"Error processing file '{file.name}': {e}")
+                pending[i] = (file, None, False)
+            waited[i] = time.perf_counter() - started
+
+        # Hand over the results in input order, an error only affects its own file
+        for i, (file, get_pages, store) in enumerate(pending):
+            if get_pages is None:
+                telemetry.record("extraction", waited[i], error=True, file=getattr(file, 'name', str(file)))
+                yield None
+                continue
+            started = time.perf_counter()
+            try:
+                pages = get_pages()
+            except Exception as e:
+                logger.error(f"Error processing file '{file.name}': {e}")
+                telemetry.record("extraction", waited[i] + time.perf_counter() - started, error=True, file=file.name)
+                yield None
+                continue
+            telemetry.record("extraction", waited[i] + time.perf_counter() - started,
+                             file=file.name, pages=len(pages), cached=not store)
+
+            if store and not isinstance(pages, IncompletePages):
+                # Cache the extracted pages under the file's hash
+                extraction_cache.put(file.digest, encode_pages(pages))
+            logger.info(f"Extracted {len(pages)} page(s) from {file.name}.")
+            yield pages
+
+    logger.info(f"Extraction cache stats: {extraction_cache.stats()}")
+
+class StreamingAnswerHandler(BaseCallbackHandler):
+    """
+    LangChain callback handler that renders LLM tokens into a Streamlit placeholder
+    as they arrive and passes the final answer to `on_complete` (e.g. to start TTS).
+    """
+
+    def __init__(self, placeholder, on_complete=None):
+        self.placeholder = placeholder
+        self.on_complete = on_complete
+        self.text = ""
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.text += token
+        self.placeholder.markdown(self.text + "▌")
+
+    def on_llm_end(self, response, **kwargs):
+        if not self.text:
+            # The model did not stream, fall back to the full generation
+            self.text = response.generations[0][0].text
+        self.placeholder.markdown(self.text)
+        if self.on_complete:
+            self.on_complete(self.text)
+
+    def on_llm_error(self, error, **kwargs):
+        # The failed answer is not kept in the chat, so its partial text is removed too
+        self.text = ""
+        self.placeholder.empty()
+
+class LLMTelemetryHandler(BaseCallbackHandler):
+    """
+    LangChain callback handler that records each LLM call as an "llm" span, with the time to its first streamed token.
+    """
+
+    def __init__(self):
+        self.started = None
+        self.first_token = None
+        self.tokens = 0
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.tokens = 0
+
+    def on_llm_new_token(self, token, **kwargs):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        self.tokens += 1
+
+    def on_llm_end(self, response, **kwargs):
+        self._record(error=False)
+
+    def on_llm_error(self, error, **kwargs):
+        self._record(error=True)
+
+    def _record(self, error):
+        if self.started is None:
+            return
+        attributes = {"kind": "answer", "streamed_tokens": self.tokens}
+        if self.first_token is not None:
+            attributes["first_token_ms"] = round((self.first_token - self.started) * 1000, 3)
+        telemetry.record("llm", time.perf_counter() - self.started, error=error, **attributes)
+        self.started = None
 
 def conversation_history_prompt(history, question):
     # Define the template string for summarizing conversation history
@@ -203,21 +448,152 @@ def conversation_history_prompt(history, question):
 
     return prompt.format(history=history, question=question)
 
+def chat_completion(formatted_prompt, temperature=0.5):
+    # Query the Azure OpenAI LLM with the formatted prompt
+    with telemetry.span("llm", kind="completion"):
+        response = openai.ChatCompletion.create(
+            engine="Voicetask",  # Replace with your Azure OpenAI deployment name
+            # prompt=formatted_prompt,
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": formatted_prompt}
+            ],
+            # max_tokens=50,
+            temperature=temperature
+        )
+    
+    # Extract and return the content of the response
+    return response.choices[0].message['content']
+
 def get_conversation_summary(history, question):
     # Get the conversation summary prompt
     formatted_prompt = conversation_history_prompt(history, question)
+    return chat_completion(formatted_prompt)
 
-    # Query the Azure OpenAI LLM with the formatted prompt
-    response = openai.ChatCompletion.create(
-        engine="Voicetask",  # Replace with your Azure OpenAI deployment name
-        # prompt=formatted_prompt,
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": formatted_prompt}
-        ],
-        # max_tokens=50,
-        temperature=0.5
+def rolling_summary_prompt(summary, turns):
+    # Define the template string for folding the newest turns into the running summary
+    template_rolling_summary = """
+    Below is a summary of a conversation between a user and an assistant about some documents \
+    (delimited by <sm></sm>), followed by the newest exchanges (delimited by <new></new>). \
+    Write an updated summary that keeps the topics, names, identifiers and facts the user may refer to later. \
+    Keep it under {max_words} words.
+    ------
+    <sm>
+    {summary}
+    </sm>
+    ------
+    <new>
+    {turns}
+    </new>
+    ------
+    Updated summary:
+    """
+
+    prompt = PromptTemplate(
+        input_variables=["summary", "turns", "max_words"],
+        template=template_rolling_summary,
     )
-    
-    # Extract and return the summary from the response
-    return response.choices[0].message['content']
+
+    return prompt.format(summary=summary or "(empty)", turns=format_turns(turns), max_words=SUMMARY_MAX_WORDS)
+
+def format_turns(turns):
+    return "\n".join(f"Human: {question}\nAI: {answer}" for question, answer in turns)
+
+# Length the rolling conversation summary is kept under
+SUMMARY_MAX_WORDS = 150
+
+_summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+# Turns kept for the summary while updating it fails, the oldest are dropped beyond this
+MAX_PENDING_TURNS = 10
+
+class RollingSummary:
+    """
+    Compact running summary of one session's conversation.
+
+    Each finished turn is folded into the summary on a background thread, so the
+    user never waits for it; turns that arrive while an update is running are
+    folded in together by the next one. The summary plus the turns not folded in
+    yet is the chat history of the QA prompt, see `RollingSummaryMemory`, which
+    stays short however long the conversation gets. While updates fail, at most
+    `MAX_PENDING_TURNS` turns are kept.
+
+    Args:
+        complete (callable): Function sending a prompt to the LLM, `chat_completion` by default
+    """
+
+    def __init__(self, complete=None):
+        self.summary = ""
+        self._complete = complete or chat_completion
+        self._pending = []
+        self._updating = False
+        self._lock = threading.Lock()
+
+    def add_turn(self, question, answer):
+        """
+        Queue a finished turn to be folded into the summary in the background.
+        """
+        with self._lock:
+            self._pending.append((question, answer))
+            if self._updating:
+                return
+            self._updating = True
+        # The update's LLM spans keep the session and request IDs of the turn that started it
+        _summary_executor.submit(contextvars.copy_context().run, self._update)
+
+    def _update(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._updating = False
+                    return
+                summary, turns = self.summary, list(self._pending)
+
+            try:
+                summary = self._complete(rolling_summary_prompt(summary, turns)).strip()
+            except Exception as e:
+                # Keep the latest turns queued, they are retried with the next turn
+                logger.warning(f"Error updating the conversation summary: {e}")
+                with self._lock:
+                    dropped = len(self._pending) - MAX_PENDING_TURNS
+                    if dropped > 0:
+                        del self._pending[:dropped]
+                        logger.warning(f"Dropped the {dropped} oldest turn(s) from the conversation summary.")
+                    self._updating = False
+                return
+
+            with self._lock:
+                self.summary = summary
+                del self._pending[:len(turns)]
+            logger.info(f"Conversation summary updated with {len(turns)} turn(s).")
+
+    def history(self):
+        """
+        Returns:
+            str: The summary followed by the turns not folded into it yet, empty before the first turn
+        """
+        with self._lock:
+            return "\n".join(part for part in (self.summary, format_turns(self._pending)) if part)
+
+class RollingSummaryMemory(BaseMemory):
+    """
+    LangChain memory that fills the QA prompt's chat history from a `RollingSummary`.
+
+    Turns are added to the summary by `pipeline.answer_question`, so saving a turn here does nothing.
+    """
+
+    conversation: Any
+    memory_key: str = "history"
+
+    @property
+    def memory_variables(self):
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs):
+        return {self.memory_key: self.conversation.history()}
+
+    def save_context(self, inputs, outputs):
+        pass
+
+    def clear(self):
+        pass
@@ -0,0 +1,139 @@
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Default memory budget for the index segments kept loaded
+SEGMENT_REGISTRY_MAX_BYTES = 1024 * 1024 * 1024
+
+
+class SegmentRegistry:
+    """
+    Process-wide registry of loaded index segments, shared read-only by all sessions.
+
+    Segments are keyed by document hash, so sessions that upload the same document
+    use the same `IndexSegment` instead of each loading their own copy. The registry
+    counts which sessions reference each segment. Segments no session references are
+    kept for later uploads until the loaded segments exceed `max_bytes`, then the
+    least recently used ones are dropped. Referenced segments are never dropped.
+
+    Args:
+        max_bytes (int): Memory budget for the loaded segments.
+    """
+
+    def __init__(self, max_bytes=SEGMENT_REGISTRY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._segments = OrderedDict()  # doc_id -> segment, least recently used first
+        self._sessions = defaultdict(set)  # doc_id -> IDs of the sessions using it
+        self._lock = threading.Lock()
+        self._loading = {}  # doc_id -> [lock held while the segment is loaded, callers holding or waiting on it]
+
+    def acquire(self, session_id, doc_id, load):
+        """
+        Returns the shared segment for `doc_id` and records that `session_id` uses it.
+
+        Args:
+            session_id (str): ID of the session.
+            doc_id (str): Content hash of the document.
+            load (callable): Returns the segment, or None, if it is not loaded yet.
+
+        Returns:
+            IndexSegment: The shared segment, or None if `load` returned None.
+        """
+        with self._lock:
+            loading = self._loading.setdefault(doc_id, [threading.Lock(), 0])
+            loading[1] += 1
+        try:
+            return self._acquire(session_id, doc_id, load, loading[0])
+        finally:
+            with self._lock:
+                loading[1] -= 1
+                # The lock is dropped once no caller uses it, a later load of the document makes a new one
+                if not loading[1]:
+                    del self._loading[doc_id]
+
+    def _acquire(self, session_id, doc_id, load, loading):
+        # Sessions asking for the same document wait for one load instead of loading it twice
+        with loading:
+            with self._lock:
+                segment = self._segments.get(doc_id)
+                if segment is not None:
+                    self.hits += 1
+                    self._segments.move_to_end(doc_id)
+                    self._sessions[doc_id].add(session_id)
+                    return segment
+                self.misses += 1
+
+            segment = load()
+            if segment is None:
+                return None
+            with self._lock:
+                self._segments[doc_id] = segment
+                self._sessions[doc_id].add(session_id)
+                total = self._evict()
+            if total > self.max_bytes:
+                logger.warning(f"Segments in use take {total} bytes, over the {self.max_bytes} byte budget.")
+            return segment
+
+    def release(self, session_id, doc_id):
+        """
+        Records that `session_id` no longer uses `doc_id`.
+        """
+        with self._lock:
+            self._sessions[doc_id].discard(session_id)
+            if not self._sessions[doc_id]:
+                del self._sessions[doc_id]
+            self._evict()
+
+    def release_session(self, session_id):
+        """
+        Releases every segment used by `session_id`, e.g. when the session ends.
+        """
+        with self._lock:
+            for doc_id in list(self._sessions):
+                self._sessions[doc_id].discard(session_id)
+                if not self._sessions[doc_id]:
+                    del self._sessions[doc_id]
+            self._evict()
+
+    def _evict(self):
+        # Returns the bytes still loaded, which exceed the budget only if every remaining segment is in use
+        total = sum(segment.nbytes() for segment in self._segments.values())
+        for doc_id in list(self._segments):
+            if total <= self.max_bytes:
+                break
+            if self._sessions.get(doc_id):
+                continue
+            segment = self._segments.pop(doc_id)
+            total -= segment.nbytes()
+            logger.info(f"Unloaded index of {segment.source} from the segment registry.")
+        return total
+
+    def memory_report(self):
+        """
+        Returns:
+            list[dict]: Document ID, source, bytes and number of sessions of each loaded segment.
+        """
+        with self._lock:
+            return [
+                {
+                    "doc_id": doc_id,
+                    "source": segment.source,
+                    "bytes": segment.nbytes(),
+                    "sessions": len(self._sessions.get(doc_id, ())),
+                }
+                for doc_id, segment in self._segments.items()
+            ]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "segments": len(self._segments),
+                "bytes": sum(segment.nbytes() for segment in self._segments.values()),
+                "sessions": len(set().union(*self._sessions.values())) if self._sessions else 0,
+            }
@@ -1,8 +1,25 @@
+import contextvars
+import hashlib
+import logging
 import os
+import re
+import shutil
+import threading
+import time
+import uuid
+import wave
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 import requests
 import azure.cognitiveservices.speech as speechsdk
 from dotenv import load_dotenv
 
+from src.audio_preprocess import preprocess_for_stt
+from src.telemetry import telemetry
+
+logger = logging.getLogger(__name__)
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -13,12 +30,163 @@ SPEECH_KEY = os.getenv("SPEECH_KEY")
 # API endpoint for speech-to-text
 STT_URL = f"https://eastus.api.cognitive.microsoft.com/speechtotext/transcriptions:transcribe?api-version=2024-05-15-preview"
 
-def transcribe_audio(audio_file_path):
+# Output formats by file extension: (Speech SDK format, MIME type)
+AUDIO_FORMATS = {
+    "wav": (speechsdk.SpeechSynthesisOutputFormat.Riff16Khz16BitMonoPcm, "audio/wav"),
+    "ogg": (speechsdk.SpeechSynthesisOutputFormat.Ogg16Khz16BitMonoOpus, "audio/ogg"),
+    "mp3": (speechsdk.SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3, "audio/mpeg"),
+}
+
+# Formats whose sentence segments can be joined into one playable file; chained Ogg streams
+# stop after the first segment in many players, so Ogg answers are synthesized in one piece
+JOINABLE_FORMATS = ("wav", "mp3")
+
+# Format of synthesized answers, MP3 is ~8x smaller than 16 kHz PCM and plays in every browser
+SPEECH_OUTPUT_FORMAT = os.getenv("SPEECH_OUTPUT_FORMAT", "mp3").lower()
+if SPEECH_OUTPUT_FORMAT not in AUDIO_FORMATS:
+    logger.warning(f"Unsupported SPEECH_OUTPUT_FORMAT {SPEECH_OUTPUT_FORMAT!r}, using mp3.")
+    SPEECH_OUTPUT_FORMAT = "mp3"
+
+def audio_format_of(path):
+    """
+    Returns:
+        str: The output format of an audio file, taken from its extension
+    """
+    audio_format = os.path.splitext(path)[1].lstrip(".").lower()
+    if audio_format not in AUDIO_FORMATS:
+        raise ValueError(f"Unsupported audio format: {audio_format}")
+    return audio_format
+
+def audio_mime_type(path):
+    return AUDIO_FORMATS[audio_format_of(path)][1]
+
+class SpeechClientManager:
+    """
+    Long-lived Azure Speech clients shared by all Streamlit sessions.
+    
+    Keeps a pool of warm SpeechSynthesizers per voice and output format, each with a pre-opened
+    connection, and a keep-alive requests.Session for the speech-to-text REST API,
+    so requests skip client setup and TLS handshakes. Synthesizers are checked out
+    by one thread at a time; the requests.Session is shared.
+    
+    Args:
+        max_idle_synthesizers (int): Synthesizers kept warm per voice and format
+    """
+
+    def __init__(self, max_idle_synthesizers=4):
+        self.max_idle_synthesizers = max_idle_synthesizers
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+        self._session = None
+        self._adapter = None
+        self._counters = defaultdict(int)
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _create_synthesizer(self, voice_name, audio_format):
+        speech_config = speechsdk.SpeechConfig(subscription=SPEECH_KEY, region=SPEECH_REGION)
+        speech_config.speech_synthesis_voice_name = voice_name
+        speech_config.set_speech_synthesis_output_format(AUDIO_FORMATS[audio_format][0])
+
+        # No audio config: the audio is returned in memory and written by the caller
+        synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+        connection = speechsdk.Connection.from_speech_synthesizer(synthesizer)
+        connection.open(True)  # connect now so the first request does not pay for it
+        self._count("synthesizers_created")
+        return synthesizer, connection
+
+    def warm_up(self, voice_name, count=1, audio_format=SPEECH_OUTPUT_FORMAT):
+        """
+        Pre-create `count` synthesizers for `voice_name` and `audio_format`.
+        """
+        key = (voice_name, audio_format)
+        with self._lock:
+            missing = min(count, self.max_idle_synthesizers) - len(self._idle[key])
+        for _ in range(max(0, missing)):
+            client = self._create_synthesizer(voice_name, audio_format)
+            with self._lock:
+                self._idle[key].append(client)
+
+    @contextmanager
+    def synthesizer(self, voice_name, audio_format=SPEECH_OUTPUT_FORMAT):
+        """
+        Check out a synthesizer for `voice_name` and `audio_format`, returning it to the pool afterwards.
+        
+        Synthesizers whose use raised an error are discarded rather than reused.
+        """
+        key = (voice_name, audio_format)
+        with self._lock:
+            client = self._idle[key].pop() if self._idle[key] else None
+        if client is None:
+            client = self._create_synthesizer(voice_name, audio_format)
+        else:
+            self._count("synthesizers_reused")
+
+        try:
+            yield client[0]
+        except Exception:
+            self._count("synthesizers_discarded")
+            raise
+        with self._lock:
+            if len(self._idle[key]) < self.max_idle_synthesizers:
+                self._idle[key].append(client)
+
+    def discard(self, voice_name):
+        """
+        Drop the idle synthesizers of a voice, in every format, e.g. after a connection error.
+        """
+        with self._lock:
+            dropped = [client for key in list(self._idle) if key[0] == voice_name for client in self._idle.pop(key)]
+        self._count("synthesizers_discarded", len(dropped))
+
+    @property
+    def http(self):
+        with self._lock:
+            if self._session is None:
+                self._session = requests.Session()
+                self._adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                self._session.mount("https://", self._adapter)
+            return self._session
+
+    def post(self, url, **kwargs):
+        """
+        POST through the keep-alive session.
+        """
+        self._count("http_requests")
+        return self.http.post(url, **kwargs)
+
+    def metrics(self):
+        """
+        Returns:
+            dict: Client creation and reuse counters, including HTTP connections opened vs requests sent
+        """
+        with self._lock:
+            metrics = dict(self._counters)
+            metrics["synthesizers_idle"] = sum(len(clients) for clients in self._idle.values())
+            connections = 0
+            if self._adapter is not None:
+                pools = self._adapter.poolmanager.pools
+                connections = sum(pools[key].num_connections for key in pools.keys())
+        metrics["http_connections_opened"] = connections
+        requests_sent = metrics.get("http_requests", 0)
+        metrics["http_connection_reuse_ratio"] = 1 - connections / requests_sent if requests_sent else 0.0
+        return metrics
+
+speech_clients = SpeechClientManager(max_idle_synthesizers=int(os.getenv("MAX_CONCURRENT_SYNTHESIS", 4)))
+# Client reuse is exported with the stage latencies, e.g. speak_to_docs_speech_clients_http_connection_reuse_ratio
+telemetry.register_gauges("speech_clients", speech_clients.metrics)
+
+def transcribe_audio(audio, filename="audio.wav", content_type="audio/wav", preprocess=True):
     """
     Transcribe audio using Azure Speech Service.
     
     Args:
-        audio_file_path (str): Path to the audio file to transcribe
+        audio (bytes | memoryview | str): The recorded audio, e.g. `UploadedFile.getbuffer()`, or the path to an audio file
+        filename (str): File name sent with in-memory audio
+        content_type (str): MIME type sent with in-memory audio
+        preprocess (bool): Trim silence and downsample in-memory WAV audio to 16 kHz mono before uploading
     
     Returns:
         str: Transcription result text
@@ -46,60 +214,254 @@ def transcribe_audio(audio_file_path):
     }
 
     try:
-        with open(audio_file_path, 'rb') as audio_file:
-            files = {'audio': audio_file}
-            # Make the POST request to the API
-            response = requests.post(STT_URL, headers=headers, files=files, data=data)
+        with telemetry.span("stt", content_type=content_type) as span:
+            if isinstance(audio, (str, os.PathLike)):
+                with open(audio, 'rb') as audio_file:
+                    files = {'audio': audio_file}
+                    # Make the POST request to the API
+                    response = speech_clients.post(STT_URL, headers=headers, files=files, data=data)
+            else:
+                if preprocess and content_type in ("audio/wav", "audio/x-wav", "audio/wave"):
+                    audio = preprocess_for_stt(audio)
+                span["bytes"] = len(audio)
+                # In-memory audio is written straight into the multipart body, without a temporary file
+                files = {'audio': (filename, audio, content_type)}
+                response = speech_clients.post(STT_URL, headers=headers, files=files, data=data)
             response.raise_for_status()  # Raise an exception for bad status codes
-            
-            result = response.json()
-            # Extract transcription from the first speaker and handle errors
-            transcription = result.get('combinedPhrases', [{}])[0].get('text', 'No transcription found.')
-            
-            return transcription
+        
+        result = response.json()
+        # Extract transcription from the first speaker and handle errors
+        transcription = result.get('combinedPhrases', [{}])[0].get('text', 'No transcription found.')
+        
+        return transcription
 
     except requests.exceptions.RequestException as e:
         error_message = f"Transcription failed: {str(e)}\nResponse: {response.text if 'response' in locals() else 'No response'}"
         raise Exception(error_message)
 
+class SpeechCache:
+    """
+    Cache of synthesized audio keyed by (normalized text, voice, output format).
+    
+    Entries are hard links to audio files in `cache_dir`, so serving a hit is a
+    link (or, where links are unsupported, a copy) and never calls Azure. The least
+    recently used entries are removed once the cache exceeds `max_bytes`; files
+    already handed to sessions are separate links and are not affected.
+    
+    Args:
+        cache_dir (str): Directory holding the cached audio
+        max_bytes (int): Upper bound on the total size of the cached audio
+    """
+
+    def __init__(self, cache_dir=os.path.join("speech_outputs", "cache"), max_bytes=200 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text, voice_name, audio_format):
+        normalized = " ".join(text.split())
+        return hashlib.sha256(f"{voice_name}\0{audio_format}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def _path(self, key, audio_format):
+        return os.path.join(self.cache_dir, f"{key}.{audio_format}")
+
+    def fetch(self, text, voice_name, output_path):
+        """
+        Place the cached audio for `text` at `output_path`.
+        
+        Returns:
+            bool: True on a cache hit
+        """
+        audio_format = os.path.splitext(output_path)[1].lstrip(".")
+        path = self._path(self.key(text, voice_name, audio_format), audio_format)
+        try:
+            os.utime(path)  # mark as recently used
+            _link_or_copy(path, output_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, text, voice_name, audio_path):
+        """
+        Add a synthesized audio file to the cache.
+        """
+        audio_format = os.path.splitext(audio_path)[1].lstrip(".")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        _link_or_copy(audio_path, self._path(self.key(text, voice_name, audio_format), audio_format))
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+def _link_or_copy(source, destination):
+    # Link into a temporary name first so an existing destination is replaced atomically
+    tmp_path = f"{destination}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(source, tmp_path)
+    except FileNotFoundError:
+        raise  # a missing source is reported to the caller, e.g. as a cache miss
+    except OSError:
+        # The filesystem does not support hard links
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+speech_cache = SpeechCache()
+
+class SpeechStorage:
+    """
+    Retention of the answer audio in `speech_outputs`, bounded per session and globally.
+    
+    Finished clips are registered with the session that requested them. When a
+    session exceeds `session_quota` bytes its oldest clips are deleted, and when all
+    clips together exceed `global_quota` the oldest clips of any session go first.
+    Files left behind by earlier runs of the app count against the global quota
+    and are evicted before anything else. The speech cache manages its own files.
+    
+    Args:
+        directory (str): Directory holding the answer audio
+        session_quota (int): Maximum bytes of audio kept per session
+        global_quota (int): Maximum bytes of audio kept for all sessions
+    """
+
+    def __init__(self, directory="speech_outputs", session_quota=20 * 1024 * 1024, global_quota=500 * 1024 * 1024):
+        self.directory = directory
+        self.session_quota = session_quota
+        self.global_quota = global_quota
+        self.evicted = 0
+        self._clips = {}  # path -> (registered at, session ID, size), in registration order
+        self._lock = threading.Lock()
+        self._started = time.time()
+
+    def add(self, session_id, path):
+        """
+        Register a finished clip of a session and evict clips over quota.
+        """
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._clips.pop(path, None)
+            self._clips[path] = (time.time(), session_id, size)
+
+            session_clips = [(clip, entry[2]) for clip, entry in self._clips.items() if entry[1] == session_id]
+            session_bytes = sum(size for _, size in session_clips)
+            for clip, clip_size in session_clips:
+                if session_bytes <= self.session_quota or clip == path:
+                    break
+                self._remove(clip)
+                session_bytes -= clip_size
+
+            # Leftovers of earlier runs are older than every registered clip
+            candidates = []
+            for entry in os.scandir(self.directory):
+                if not entry.is_file() or entry.name.endswith(".tmp") or entry.path in self._clips:
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if stat.st_mtime < self._started:
+                    candidates.append((stat.st_mtime, entry.path, stat.st_size))
+            candidates.sort()
+            candidates += [(entry[0], clip, entry[2]) for clip, entry in self._clips.items()]
+
+            total = sum(size for _, _, size in candidates)
+            for _, clip, clip_size in candidates:
+                if total <= self.global_quota or clip == path:
+                    break
+                self._remove(clip)
+                total -= clip_size
+
+    def _remove(self, path):
+        self._clips.pop(path, None)
+        try:
+            os.remove(path)
+            self.evicted += 1
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "clips": len(self._clips),
+                "bytes": sum(entry[2] for entry in self._clips.values()),
+                "evicted": self.evicted,
+            }
+
+speech_storage = SpeechStorage(
+    session_quota=int(os.getenv("SPEECH_SESSION_QUOTA_MB", 20)) * 1024 * 1024,
+    global_quota=int(os.getenv("SPEECH_GLOBAL_QUOTA_MB", 500)) * 1024 * 1024,
+)
+
 def synthesize_speech(text, output_file="output.wav", voice_name='en-NG-EzinneNeural', verbose=False):
     """
     Synthesize speech from text using Azure Speech Service.
     
     Args:
         text (str): Text to synthesize
-        output_file (str): Path for the output audio file
+        output_file (str): Path for the output audio file, its extension (wav, ogg or mp3) selects the format
         voice_name (str): Name of the voice to use for synthesis
     
     Returns:
         tuple: (bool, str) - True if synthesis was successful, False otherwise and a message
     """
-    if not SPEECH_KEY or not SPEECH_REGION:
-        return False, "Azure Speech Service credentials are missing."
-    
     path = "speech_outputs"
     os.makedirs(path, exist_ok=True)
     output_file = os.path.join(path, output_file)
 
-    output = open(output_file, 'w+')
-    output.close()
-    
+    # Canned and repeated answers are served from the cache without using Speech quota
+    if speech_cache.fetch(text, voice_name, output_file):
+        return True, "Speech synthesis served from cache."
+
+    if not SPEECH_KEY or not SPEECH_REGION:
+        return False, "Azure Speech Service credentials are missing."
+
     try:
-        # Configure speech service
-        speech_config = speechsdk.SpeechConfig(subscription=SPEECH_KEY, region=SPEECH_REGION)   
-        audio_config = speechsdk.audio.AudioOutputConfig(filename=output_file)
-        
-        # Set the voice for synthesis
-        speech_config.speech_synthesis_voice_name = voice_name
-        
-        # Create synthesizer and generate speech
-        speech_synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=audio_config)
-        result = speech_synthesizer.speak_text_async(text).get()
+        # Generate speech with a pooled synthesizer for the voice and format
+        with telemetry.span("tts", chars=len(text), voice=voice_name) as span:
+            with speech_clients.synthesizer(voice_name, audio_format_of(output_file)) as speech_synthesizer:
+                result = speech_synthesizer.speak_text_async(text).get()
+            span["reason"] = result.reason.name
         
         # Handle the result
         if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
+            with open(output_file, 'wb') as output:
+                output.write(result.audio_data)
             if verbose:
                 print(f"Speech synthesized successfully for text: {text}")
+            speech_cache.store(text, voice_name, output_file)
             return True, "Speech synthesis completed successfully."
         
         elif result.reason == speechsdk.ResultReason.Canceled:
@@ -110,6 +472,8 @@ def synthesize_speech(text, output_file="output.wav", voice_name='en-NG-EzinneNe
             
             if cancellation_details.reason == speechsdk.CancellationReason.Error and cancellation_details.error_details:
                 error_message += f" Error details: {cancellation_details.error_details}."
+                # The pooled connections may be broken, start afresh next time
+                speech_clients.discard(voice_name)
                 if verbose:
                     print("Did you set the speech resource key and region values?")
             
@@ -121,6 +485,239 @@ def synthesize_speech(text, output_file="output.wav", voice_name='en-NG-EzinneNe
             print(error_message)
         return False, error_message
 
+# Cap on the number of synthesis jobs running at once, shared by all sessions
+MAX_CONCURRENT_SYNTHESIS = int(os.getenv("MAX_CONCURRENT_SYNTHESIS", 4))
+# Sentences of one answer queued on the shared executor at once, so a long answer does not hold every worker
+MAX_SEGMENTS_IN_FLIGHT = int(os.getenv("SPEECH_SEGMENTS_IN_FLIGHT", 2))
+_synthesis_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_SYNTHESIS, thread_name_prefix="synthesis")
+_session_jobs = defaultdict(set)
+_session_jobs_lock = threading.Lock()
+
+def _forget_job(session_id, future):
+    with _session_jobs_lock:
+        _session_jobs[session_id].discard(future)
+        if not _session_jobs[session_id]:
+            del _session_jobs[session_id]
+
+def _track_job(session_id, future):
+    # Registers a job of a session for cancellation until it is done
+    if session_id is not None:
+        with _session_jobs_lock:
+            _session_jobs[session_id].add(future)
+        future.add_done_callback(lambda done: _forget_job(session_id, done))
+
+def cancel_session_synthesis(session_id):
+    """
+    Cancel the synthesis jobs of a session that have not started yet.
+    
+    Returns:
+        int: Number of jobs cancelled
+    """
+    with _session_jobs_lock:
+        futures = list(_session_jobs.get(session_id, ()))
+    return sum(1 for future in futures if future.cancel())
+
+def split_sentences(text, min_chars=20):
+    """
+    Split text into sentences for pipelined synthesis, merging very short fragments into the next sentence.
+    
+    Args:
+        text (str): Text to split
+        min_chars (int): Sentences shorter than this are merged with the following one
+    
+    Returns:
+        list: Sentences in order
+    """
+    sentences = []
+    current = ""
+    for part in re.split(r"(?<=[.!?])\s+", text.strip()):
+        current = f"{current} {part}" if current else part
+        if len(current) >= min_chars:
+            sentences.append(current)
+            current = ""
+    if current:
+        if sentences:
+            sentences[-1] = f"{sentences[-1]} {current}"
+        else:
+            sentences.append(current)
+    return sentences
+
+class SpeechJob:
+    """
+    Sentence-pipelined synthesis of one answer.
+    
+    Each sentence is synthesized into its own segment file on the shared background
+    executor, in order, so the first sentence is playable while later ones are still
+    being rendered. At most `MAX_SEGMENTS_IN_FLIGHT` sentences of a job are queued on
+    the executor at once, the next one when a segment finishes, so one long answer
+    does not delay every other session. Once every segment is done, `finalize` joins them into
+    `output_file` and registers it with `speech_storage` under the session's quota.
+    Formats that cannot be joined (Ogg) are synthesized as a single segment.
+    
+    Args:
+        text (str): Text to synthesize
+        output_file (str): Name of the final audio file in speech_outputs, its extension selects the format
+        session_id (str): ID of the session the job belongs to, used for cancellation
+        **kwargs: Other arguments of synthesize_speech
+    """
+
+    def __init__(self, text, output_file, session_id=None, **kwargs):
+        self.text = text
+        self.voice_name = kwargs.get("voice_name", "en-NG-EzinneNeural")
+        self.output_file = output_file
+        self.output_path = os.path.join("speech_outputs", output_file)
+        self.session_id = session_id
+        self._lock = threading.Lock()
+        self._result = None
+        self._audio = None
+        base, ext = os.path.splitext(output_file)
+        self.segments = []
+        self._kwargs = kwargs
+        self._queue = deque()
+        # Segments run in a copy of the caller's context, so their spans keep its session and request IDs
+        self._context = contextvars.copy_context()
+
+        # A repeated answer is reused as a whole, without synthesizing any segment
+        os.makedirs("speech_outputs", exist_ok=True)
+        if speech_cache.fetch(text, self.voice_name, self.output_path):
+            self._result = (True, "Speech synthesis served from cache.")
+            speech_storage.add(session_id, self.output_path)
+            return
+
+        sentences = split_sentences(text) if audio_format_of(output_file) in JOINABLE_FORMATS else [text]
+        for i, sentence in enumerate(sentences):
+            segment_file = f"{base}_{i:03d}{ext}"
+            # Resolved by `_synthesize_segment`, cancelled by `cancel_session_synthesis` until it starts
+            future = Future()
+            _track_job(session_id, future)
+            self.segments.append((segment_file, future))
+            self._queue.append((sentence, segment_file, future))
+        for _ in range(MAX_SEGMENTS_IN_FLIGHT):
+            self._submit_next()
+
+    def _submit_next(self):
+        with self._lock:
+            while self._queue and self._queue[0][2].cancelled():
+                self._queue.popleft()
+            if not self._queue:
+                return
+            segment = self._queue.popleft()
+        _synthesis_executor.submit(self._context.copy().run, self._synthesize_segment, *segment)
+
+    def _synthesize_segment(self, sentence, segment_file, future):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(synthesize_speech(sentence, segment_file, **self._kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            self._submit_next()
+
+    def done(self):
+        return all(future.done() for _, future in self.segments)
+
+    def ready_segments(self):
+        """
+        Returns:
+            list: Names of the leading segments that were synthesized successfully, in playback order
+        """
+        ready = []
+        for segment_file, future in self.segments:
+            if not future.done() or future.cancelled() or not future.result()[0]:
+                break
+            ready.append(segment_file)
+        return ready
+
+    def finalize(self):
+        """
+        Join the segments into the output file once every segment is done.
+        
+        Returns:
+            tuple: (bool, str) - True if the whole answer was synthesized, False otherwise and a message
+        """
+        with self._lock:
+            if self._result is not None:
+                return self._result
+            if not self.done():
+                return False, "Speech synthesis is still running."
+
+            segment_paths = [os.path.join("speech_outputs", segment_file) for segment_file, _ in self.segments]
+            for segment_file, future in self.segments:
+                if future.cancelled():
+                    self._result = (False, "Speech synthesis was cancelled.")
+                elif future.exception() is not None:
+                    self._result = (False, f"An error occurred during speech synthesis: {str(future.exception())}")
+                elif not future.result()[0]:
+                    self._result = (False, future.result()[1])
+                if self._result is not None:
+                    # An incomplete answer is never played, its synthesized segments would only pile up on disk
+                    _remove_files(segment_paths)
+                    return self._result
+
+            try:
+                join_audio_files(segment_paths, self.output_path)
+                speech_cache.store(self.text, self.voice_name, self.output_path)
+                speech_storage.add(self.session_id, self.output_path)
+                self._result = (True, "Speech synthesis completed successfully.")
+            except Exception as e:
+                _remove_files(segment_paths)
+                self._result = (False, f"An error occurred while joining the speech segments: {str(e)}")
+            return self._result
+
+    def evicted(self):
+        """
+        Returns:
+            bool: True if the finished audio was deleted by the retention quotas
+        """
+        return self._result is not None and self._result[0] and not os.path.exists(self.output_path)
+
+    def audio(self):
+        """
+        Returns:
+            bytes: The finished audio, read from disk once and kept for later reruns, or None if unavailable
+        """
+        if self._audio is None and self.finalize()[0]:
+            try:
+                with open(self.output_path, "rb") as f:
+                    self._audio = f.read()
+            except FileNotFoundError:
+                return None
+        return self._audio
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def join_audio_files(segment_paths, output_path):
+    """
+    Concatenate audio files with identical formats into one file and delete the segments.
+    
+    WAV segments are merged into a single RIFF file. MP3 files are plain sequences of
+    frames, so those segments are concatenated as they are. Other formats (Ogg) are only
+    accepted as a single segment, since chained streams do not play through everywhere.
+    """
+    audio_format = audio_format_of(output_path)
+    if audio_format not in JOINABLE_FORMATS and len(segment_paths) > 1:
+        raise ValueError(f"Cannot join {len(segment_paths)} {audio_format} segments into one file")
+    if audio_format == "wav":
+        with wave.open(output_path, "wb") as output:
+            for i, segment_path in enumerate(segment_paths):
+                with wave.open(segment_path, "rb") as segment:
+                    if i == 0:
+                        output.setparams(segment.getparams())
+                    output.writeframes(segment.readframes(segment.getnframes()))
+    else:
+        with open(output_path, "wb") as output:
+            for segment_path in segment_paths:
+                with open(segment_path, "rb") as segment:
+                    shutil.copyfileobj(segment, output)
+    for segment_path in segment_paths:
+        os.remove(segment_path)
+
 def main():
     # Example usage
     try:
@@ -0,0 +1,262 @@
+import contextvars
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Stages of the voice-RAG pipeline that are timed
+STAGES = ("upload_validation", "extraction", "chunking", "embedding", "retrieval", "llm", "stt", "tts")
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Latest durations kept per stage to compute the quantiles
+QUANTILE_WINDOW = 2048
+QUANTILES = (0.5, 0.95, 0.99)
+METRIC_PREFIX = "speak_to_docs"
+
+# IDs attached to every span recorded in the current context
+session_id_var = contextvars.ContextVar("session_id", default=None)
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+@contextmanager
+def context(session_id=None, request_id=None):
+    '''
+    Attaches `session_id` and `request_id` to the spans recorded inside the block; None keeps the current value
+    '''
+    tokens = []
+    if session_id is not None:
+        tokens.append((session_id_var, session_id_var.set(session_id)))
+    if request_id is not None:
+        tokens.append((request_id_var, request_id_var.set(request_id)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class StageMetrics:
+    """
+    Latency histogram of one stage, with the latest durations kept for quantiles.
+    """
+
+    def __init__(self, window=QUANTILE_WINDOW):
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds, error=False):
+        self.bucket_counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.errors += int(error)
+        self.total += seconds
+        self.recent.append(seconds)
+
+    def quantiles(self, quantiles=QUANTILES):
+        '''
+        Returns the nearest-rank quantiles of the latest durations, NaN if nothing was recorded
+        '''
+        ordered = sorted(self.recent)
+        if not ordered:
+            return {q: math.nan for q in quantiles}
+        return {q: ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)] for q in quantiles}
+
+
+class Telemetry:
+    """
+    Per-stage latency spans for the whole pipeline.
+
+    Every span is counted in a histogram of its stage, exported in the Prometheus text
+    format by `render_prometheus` or `serve`, and, when `trace_path` is set, written as one
+    JSON line with the session and request IDs of the context it was recorded in. Other
+    components can add their own numbers to the export with `register_gauges`.
+
+    Args:
+        trace_path (str): JSONL file the spans are appended to, None to keep no trace.
+    """
+
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+        self._stages = {stage: StageMetrics() for stage in STAGES}
+        self._lock = threading.Lock()
+        self._trace_file = None
+        self._server = None
+        self._gauges = {}  # name -> function returning {metric: number}
+
+    def record(self, stage, seconds, error=False, **attributes):
+        """
+        Records a span that has already been timed.
+
+        Args:
+            stage (str): Pipeline stage, one of `STAGES` or a new one.
+            seconds (float): Duration of the span.
+            error (bool): Whether the stage failed.
+            **attributes: Extra fields of the trace line, e.g. the file name or number of chunks.
+        """
+        with self._lock:
+            metrics = self._stages.get(stage)
+            if metrics is None:
+                metrics = self._stages[stage] = StageMetrics()
+            metrics.observe(seconds, error)
+            if self.trace_path:
+                self._write_trace(stage, seconds, error, attributes)
+
+    def _write_trace(self, stage, seconds, error, attributes):
+        line = {
+            "time": round(time.time() - seconds, 6),
+            "stage": stage,
+            "duration_ms": round(seconds * 1000, 3),
+            "status": "error" if error else "ok",
+            "session_id": session_id_var.get(),
+            "request_id": request_id_var.get(),
+            **attributes,
+        }
+        try:
+            if self._trace_file is None:
+                self._trace_file = open(self.trace_path, "a", encoding="utf-8")
+            self._trace_file.write(json.dumps(line, default=str) + "\n")
+            self._trace_file.flush()
+        except OSError as e:
+            logger.warning(f"Error writing trace to {self.trace_path}, tracing disabled: {e}")
+            self.trace_path = None
+
+    @contextmanager
+    def span(self, stage, **attributes):
+        """
+        Times the block as a span of `stage`.
+
+        Yields:
+            dict: The span's attributes, which the block can add to (e.g. the number of chunks produced).
+        """
+        start = time.perf_counter()
+        error = False
+        try:
+            yield attributes
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - start, error=error, **attributes)
+
+    def register_gauges(self, name, collect):
+        """
+        Exports the numbers returned by `collect` as `<prefix>_<name>_<metric>` gauges on every scrape.
+
+        Args:
+            name (str): Prefix of the gauges, e.g. "speech_clients".
+            collect (callable): Returns a dict of metric name to number, called without the telemetry lock.
+        """
+        with self._lock:
+            self._gauges[name] = collect
+
+    def summary(self):
+        """
+        Returns:
+            dict: Count, errors and p50/p95/p99 in milliseconds of every stage that recorded a span.
+        """
+        with self._lock:
+            return {
+                stage: {
+                    "count": metrics.count,
+                    "errors": metrics.errors,
+                    **{f"p{round(q * 100)}_ms": round(v * 1000, 3) for q, v in metrics.quantiles().items()},
+                }
+                for stage, metrics in self._stages.items() if metrics.count
+            }
+
+    def render_prometheus(self):
+        """
+        Returns:
+            str: Span counts, errors, latency histograms and quantiles in the Prometheus text format.
+        """
+        duration = f"{METRIC_PREFIX}_stage_duration_seconds"
+        recent = f"{METRIC_PREFIX}_stage_recent_duration_seconds"
+        errors = f"{METRIC_PREFIX}_stage_errors_total"
+        lines = [
+            f"# HELP {duration} Duration of the pipeline stages.",
+            f"# TYPE {duration} histogram",
+        ]
+        recent_lines = [
+            f"# HELP {recent} Quantiles of the latest {QUANTILE_WINDOW} durations of each stage.",
+            f"# TYPE {recent} summary",
+        ]
+        error_lines = [
+            f"# HELP {errors} Pipeline stage spans that raised an error.",
+            f"# TYPE {errors} counter",
+        ]
+        with self._lock:
+            gauges = dict(self._gauges)
+            for stage, metrics in self._stages.items():
+                label = f'stage="{stage}"'
+                cumulative = 0
+                for bound, count in zip([*map(str, LATENCY_BUCKETS), "+Inf"], metrics.bucket_counts):
+                    cumulative += count
+                    lines.append(f'{duration}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f"{duration}_sum{{{label}}} {metrics.total}")
+                lines.append(f"{duration}_count{{{label}}} {metrics.count}")
+                for q, value in metrics.quantiles().items():
+                    recent_lines.append(f'{recent}{{{label},quantile="{q}"}} {value}')
+                recent_lines.append(f"{recent}_sum{{{label}}} {sum(metrics.recent)}")
+                recent_lines.append(f"{recent}_count{{{label}}} {len(metrics.recent)}")
+                error_lines.append(f"{errors}{{{label}}} {metrics.errors}")
+        gauge_lines = []
+        for name, collect in gauges.items():
+            try:
+                values = collect()
+            except Exception as e:
+                logger.warning(f"Error collecting the {name} metrics: {e}")
+                continue
+            for metric, value in values.items():
+                gauge = f"{METRIC_PREFIX}_{name}_{metric}"
+                gauge_lines += [f"# TYPE {gauge} gauge", f"{gauge} {float(value)}"]
+        return "\n".join(lines + recent_lines + error_lines + gauge_lines) + "\n"
+
+    def serve(self, port, host="0.0.0.0"):
+        """
+        Serves `render_prometheus` at http://host:port/metrics from a background thread.
+
+        Returns:
+            ThreadingHTTPServer: The running server; calling `serve` again returns the same one.
+        """
+        if self._server is not None:
+            return self._server
+        telemetry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = telemetry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes would otherwise be printed to stderr
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        logger.info(f"Serving metrics at http://{host}:{port}/metrics")
+        return self._server
+
+
+telemetry = Telemetry(trace_path=os.getenv("TELEMETRY_TRACE_FILE") or None)
@@ -0,0 +1,405 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from src.ann import EXACT_SEARCH_THRESHOLD, IVFSearcher, build_searcher
+from src.context_packing import MMR_LAMBDA, pack_context
+from src.lexical_index import BM25Index, identifier_term, tokenize
+from src.telemetry import telemetry
+
+logger = logging.getLogger(__name__)
+
+# Directory holding one sub-directory per indexed document
+INDEX_DIR = "vector_index"
+VECTORS_FILE = "vectors.f32"
+METADATA_FILE = "meta.json"
+IVF_FILE = "ivf.npz"
+LEXICAL_FILE = "bm25.npz"
+# Constant of reciprocal-rank fusion, damps the weight of the top ranks of each list
+RRF_K = 60
+
+
+def document_hash(data):
+    '''
+    Returns the content hash that identifies an uploaded document in the index
+    '''
+    return hashlib.sha256(data).hexdigest()
+
+
+def locate_chunks(text, chunks):
+    '''
+    Returns the character offset of each chunk in `text`, or -1 if a chunk cannot be found
+    '''
+    offsets = []
+    position = 0
+    for chunk in chunks:
+        offset = text.find(chunk, position)
+        if offset == -1:
+            offset = text.find(chunk)
+        offsets.append(offset)
+        if offset != -1:
+            # Chunks overlap, so the next one starts somewhere after this one's start
+            position = offset + 1
+    return offsets
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class IndexSegment:
+    """
+    Embedded chunks of a single document, stored on disk as a float32 matrix
+    (`vectors.f32`) plus a metadata file with the chunk text, source file, page and offsets.
+
+    Vectors are L2-normalised before they are written, so cosine similarity is a dot product.
+    Loaded segments memory-map the matrix instead of reading it into memory. Segments
+    with at least `EXACT_SEARCH_THRESHOLD` chunks also store an IVF index (`ivf.npz`).
+    A BM25 index of the chunk text (`bm25.npz`) is stored next to the vectors.
+
+    Segments are read-only once loaded, so one instance can be shared by all sessions.
+    """
+
+    def __init__(self, doc_id, source, vectors, chunks, searcher=None, lexical=None):
+        self.doc_id = doc_id
+        self.source = source
+        self.vectors = vectors
+        self.chunks = chunks
+        self._searcher = searcher
+        self._lexical = lexical
+        self._lock = threading.Lock()
+
+    @property
+    def searcher(self):
+        with self._lock:
+            if self._searcher is None:
+                self._searcher = build_searcher(self.vectors)
+            return self._searcher
+
+    @property
+    def lexical(self):
+        with self._lock:
+            if self._lexical is None:
+                # Segments indexed before the BM25 index existed
+                self._lexical = BM25Index.build([chunk["text"] for chunk in self.chunks])
+            return self._lexical
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def nbytes(self):
+        """
+        Returns:
+            int: Approximate memory used by the segment, counting the memory-mapped vectors in full.
+        """
+        total = self.vectors.nbytes + sum(len(chunk["text"]) for chunk in self.chunks)
+        if self._lexical is not None:
+            total += self._lexical.nbytes()
+        if isinstance(self._searcher, IVFSearcher):
+            total += self._searcher.centroids.nbytes + self._searcher.ids.nbytes + self._searcher.offsets.nbytes
+        return total
+
+    @staticmethod
+    def path(doc_id, index_dir=INDEX_DIR):
+        return os.path.join(index_dir, doc_id)
+
+    @classmethod
+    def build(cls, doc_id, source, chunks, embeddings, index_dir=INDEX_DIR, persist=True):
+        """
+        Embeds the chunks of a document and writes them to the on-disk index.
+
+        Args:
+            doc_id (str): Content hash of the document.
+            source (str): Name of the uploaded file.
+            chunks (list[dict]): Chunks to embed, with their "text", "page" and "start" offset in the page.
+            embeddings (Embeddings): Model used to embed the chunks.
+            index_dir (str): Root directory of the index.
+            persist (bool): Write the segment to the index; False keeps it in memory only, e.g. for incomplete extractions.
+
+        Returns:
+            IndexSegment: The segment, memory-mapped from disk unless `persist` is False.
+        """
+        with telemetry.span("embedding", source=source, chunks=len(chunks)):
+            vectors = np.asarray(embeddings.embed_documents([chunk["text"] for chunk in chunks]), dtype=np.float32)
+        if len(chunks) == 0:
+            vectors = vectors.reshape(0, 0)
+        vectors = _normalize(vectors)
+        if not persist:
+            return cls(doc_id, source, vectors, chunks)
+
+        metadata = {
+            "doc_id": doc_id,
+            "source": source,
+            "count": int(vectors.shape[0]),
+            "dim": int(vectors.shape[1]),
+            "chunks": chunks,
+        }
+
+        # Write into a scratch directory and move it into place, so readers never see a partial segment
+        os.makedirs(index_dir, exist_ok=True)
+        tmp_dir = os.path.join(index_dir, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+        try:
+            vectors.tofile(os.path.join(tmp_dir, VECTORS_FILE))
+            if len(vectors) >= EXACT_SEARCH_THRESHOLD:
+                IVFSearcher(vectors).save(os.path.join(tmp_dir, IVF_FILE))
+            BM25Index.build([chunk["text"] for chunk in chunks]).save(os.path.join(tmp_dir, LEXICAL_FILE))
+            with open(os.path.join(tmp_dir, METADATA_FILE), "w", encoding="utf-8") as f:
+                json.dump(metadata, f, separators=(",", ":"))
+            os.replace(tmp_dir, cls.path(doc_id, index_dir))
+            logger.info(f"Indexed {source} ({len(chunks)} chunks) as {doc_id}.")
+        except OSError as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.exists(os.path.join(cls.path(doc_id, index_dir), METADATA_FILE)):
+                # Not a concurrent write of the same document (e.g. the disk is full), serve this session from memory
+                logger.warning(f"Error writing the index of {source}, keeping it in memory only: {e}")
+                return cls(doc_id, source, vectors, chunks)
+            # Otherwise another session indexed the same document first
+
+        return cls.load(doc_id, index_dir)
+
+    @classmethod
+    def load(cls, doc_id, index_dir=INDEX_DIR):
+        """
+        Returns:
+            IndexSegment: The segment stored for `doc_id`, or None if the document has not been indexed.
+        """
+        path = cls.path(doc_id, index_dir)
+        try:
+            with open(os.path.join(path, METADATA_FILE), "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        count, dim = metadata["count"], metadata["dim"]
+        if count == 0:
+            vectors = np.empty((0, dim), dtype=np.float32)
+        else:
+            vectors = np.memmap(os.path.join(path, VECTORS_FILE), dtype=np.float32, mode="r", shape=(count, dim))
+
+        searcher = None
+        if os.path.exists(os.path.join(path, IVF_FILE)):
+            searcher = IVFSearcher.load(os.path.join(path, IVF_FILE), vectors)
+        lexical = None
+        if os.path.exists(os.path.join(path, LEXICAL_FILE)):
+            lexical = BM25Index.load(os.path.join(path, LEXICAL_FILE))
+        return cls(doc_id, metadata["source"], vectors, metadata["chunks"], searcher, lexical)
+
+    def document(self, i, score=None):
+        '''
+        Returns chunk `i` as a LangChain Document
+        '''
+        chunk = self.chunks[i]
+        metadata = {"source": self.source, "doc_id": self.doc_id, "start_index": chunk["start"]}
+        if "page" in chunk:
+            metadata["page"] = chunk["page"]
+        if score is not None:
+            metadata["score"] = float(score)
+        return Document(page_content=chunk["text"], metadata=metadata)
+
+    def search(self, query_vector, k, n_probe=None):
+        """
+        Returns:
+            list[tuple[float, int]]: The `k` best (cosine similarity, chunk position) pairs, best first.
+        """
+        return self.searcher.search(query_vector, k, n_probe=n_probe)
+
+
+class VectorIndex:
+    """
+    Searchable view over the segments of the documents uploaded in a session.
+
+    Documents can be added and removed by ID, so a change of uploads only embeds
+    the new documents. Retrievers hold a reference to the index and always query
+    its current contents.
+
+    Args:
+        segments (list[IndexSegment]): The indexed documents.
+        embeddings (Embeddings): Model used to embed queries.
+    """
+
+    # Recent query embeddings kept, so a question embedded for the answer cache is not embedded again for retrieval
+    QUERY_CACHE_SIZE = 16
+
+    def __init__(self, segments, embeddings):
+        self._segments = {segment.doc_id: segment for segment in segments}
+        self.embeddings = embeddings
+        self._query_vectors = OrderedDict()
+
+    @property
+    def segments(self):
+        return list(self._segments.values())
+
+    @property
+    def doc_ids(self):
+        return list(self._segments)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._segments
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def add(self, segment):
+        """
+        Adds a document to the index, replacing any document with the same ID.
+        """
+        self._segments[segment.doc_id] = segment
+        logger.info(f"Added {segment.source} ({len(segment)} chunks) to the index.")
+
+    def remove(self, doc_id):
+        """
+        Removes a document from the index, the on-disk segment is kept for later uploads.
+        """
+        segment = self._segments.pop(doc_id, None)
+        if segment is not None:
+            logger.info(f"Removed {segment.source} from the index.")
+
+    def embed_query(self, query):
+        """
+        Returns:
+            np.ndarray: The L2-normalised embedding of `query`.
+        """
+        vector = self._query_vectors.pop(query, None)
+        if vector is None:
+            with telemetry.span("embedding", chunks=1, query=True):
+                vector = _normalize(np.asarray(self.embeddings.embed_query(query), dtype=np.float32))
+        self._query_vectors[query] = vector
+        while len(self._query_vectors) > self.QUERY_CACHE_SIZE:
+            self._query_vectors.popitem(last=False)
+        return vector
+
+    def _search(self, query_vector, k, n_probe=None):
+        candidates = []
+        for segment in self.segments:
+            for score, i in segment.search(query_vector, k, n_probe=n_probe):
+                candidates.append((score, segment, i))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        return candidates[:k]
+
+    def lexical_search(self, terms, k):
+        """
+        Returns:
+            list[tuple[float, IndexSegment, int]]: The `k` best BM25 matches for `terms` across all segments.
+        """
+        candidates = []
+        for segment in self.segments:
+            for score, i in segment.lexical.search(terms, k):
+                candidates.append((score, segment, i))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        return candidates[:k]
+
+    def hybrid_search(self, query, k, n_probe=None):
+        """
+        Dense and BM25 retrieval fused with reciprocal-rank fusion.
+
+        A query that is a bare identifier, part number or acronym found in the documents
+        is answered from the inverted index alone, without embedding the query.
+
+        Returns:
+            tuple: The `k` best (fused score, segment, chunk position) triples and the query vector,
+            which is None for exact-match lookups.
+        """
+        term = identifier_term(query)
+        if term is not None:
+            matches = self.lexical_search([term], k)
+            if matches:
+                logger.info(f"Answered {query!r} from the inverted index.")
+                return matches, None
+
+        query_vector = self.embed_query(query)
+        fused = {}
+        for ranking in (self._search(query_vector, k, n_probe=n_probe), self.lexical_search(tokenize(query), k)):
+            for rank, (_, segment, i) in enumerate(ranking):
+                key = (segment.doc_id, i)
+                score = fused.get(key, (0.0, segment, i))[0] + 1 / (RRF_K + rank + 1)
+                fused[key] = (score, segment, i)
+        candidates = sorted(fused.values(), key=lambda candidate: candidate[0], reverse=True)
+        return candidates[:k], query_vector
+
+    def similarity_search_with_score(self, query, k=4, n_probe=None):
+        """
+        Args:
+            query (str): The user's question.
+            k (int): Number of chunks to return.
+            n_probe (int): IVF lists probed per segment, trading speed for recall on large segments.
+
+        Returns:
+            list[tuple[Document, float]]: The `k` chunks most similar to `query` across all segments.
+        """
+        candidates = self._search(self.embed_query(query), k, n_probe=n_probe)
+        return [(segment.document(i, score), score) for score, segment, i in candidates]
+
+    def similarity_search(self, query, k=4, n_probe=None):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, n_probe=n_probe)]
+
+    def packed_search(self, query, token_budget, fetch_k=20, lambda_mult=MMR_LAMBDA, n_probe=None, hybrid=False):
+        """
+        Args:
+            query (str): The user's question.
+            token_budget (int): Maximum number of context tokens to return.
+            fetch_k (int): Number of chunks retrieved before selection.
+            lambda_mult (float): MMR relevance/diversity trade-off.
+            n_probe (int): IVF lists probed per segment.
+            hybrid (bool): Fuse dense and BM25 retrieval, see `hybrid_search`.
+
+        Returns:
+            list[Document]: Diverse, de-duplicated context for `query` that fits in `token_budget`.
+        """
+        if hybrid:
+            candidates, query_vector = self.hybrid_search(query, fetch_k, n_probe=n_probe)
+        else:
+            query_vector = self.embed_query(query)
+            candidates = self._search(query_vector, fetch_k, n_probe=n_probe)
+        return pack_context(candidates, query_vector, token_budget=token_budget, lambda_mult=lambda_mult)
+
+    def as_retriever(self, search_kwargs=None):
+        return VectorIndexRetriever(index=self, **(search_kwargs or {}))
+
+
+class VectorIndexRetriever(BaseRetriever):
+    """
+    LangChain retriever that queries a `VectorIndex` directly.
+
+    Returns the `k` most similar chunks, or, when `token_budget` is set, as much
+    diverse and de-duplicated context as fits in the budget. With `hybrid` set,
+    candidates come from `VectorIndex.hybrid_search`.
+    """
+
+    index: Any
+    k: int = 4
+    n_probe: Optional[int] = None
+    token_budget: Optional[int] = None
+    fetch_k: int = 20
+    lambda_mult: float = MMR_LAMBDA
+    hybrid: bool = False
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        with telemetry.span("retrieval", hybrid=self.hybrid) as span:
+            if self.token_budget is not None:
+                documents = self.index.packed_search(query, self.token_budget, fetch_k=self.fetch_k,
+                                                     lambda_mult=self.lambda_mult, n_probe=self.n_probe,
+                                                     hybrid=self.hybrid)
+            elif self.hybrid:
+                candidates, _ = self.index.hybrid_search(query, self.k, n_probe=self.n_probe)
+                documents = [segment.document(i, score) for score, segment, i in candidates]
+            else:
+                documents = self.index.similarity_search(query, k=self.k, n_probe=self.n_probe)
+            span["documents"] = len(documents)
+        return documents